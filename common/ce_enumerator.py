@@ -0,0 +1,92 @@
+# -----------------------------------------------------------------
+# ce_enumerator.py
+#
+# Enumerates the CLOUD-ENVIRONMENTS table of an enterprise environment. The table
+# is read with parallel Segment / TotalSegments scans projected on the requested
+# attributes, every segment follows LastEvaluatedKey to the end, so large
+# environments are not truncated at the 1 MB page limit. The items are streamed
+# to the caller as the pages arrive.
+#
+# Used by enterprise-ce-deletion and extract-inventory/concurrency, which add the
+# common directory to sys.path.
+#
+# -----------------------------------------------------------------
+
+import queue
+import logging
+
+from boto3.dynamodb.types import TypeDeserializer
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "CLOUD-ENVIRONMENTS"
+CE_NAME = "cloud-environment"
+TOTAL_SEGMENTS = 4
+
+_deserializer = TypeDeserializer()
+
+
+def _scan_segment(dynamodb_client, scan_kwargs, segment, total_segments, pages):
+    try:
+        paginator = dynamodb_client.get_paginator("scan")
+        for page in paginator.paginate(
+            **scan_kwargs, Segment=segment, TotalSegments=total_segments
+        ):
+            pages.put(page["Items"])
+    finally:
+        # the end of the segment, also when it failed
+        pages.put(None)
+
+
+def iter_cloud_environments(
+    dynamodb_client,
+    attributes=(CE_NAME,),
+    filter_expression: str = None,
+    expression_attribute_names: dict = None,
+    expression_attribute_values: dict = None,
+    total_segments: int = TOTAL_SEGMENTS,
+    table_name: str = TABLE_NAME,
+):
+    """Yields every cloud environment item of the table with the projected attributes.
+
+    filter_expression is evaluated by DynamoDB, its names and values are passed in the
+    low level format, e.g. {":deletion": {"S": "-DELETION-"}}.
+    """
+    names = {f"#a{index}": attribute for index, attribute in enumerate(attributes)}
+    scan_kwargs = {
+        "TableName": table_name,
+        "ProjectionExpression": ",".join(names),
+        "ExpressionAttributeNames": {**names, **(expression_attribute_names or {})},
+    }
+    if filter_expression:
+        scan_kwargs["FilterExpression"] = filter_expression
+    if expression_attribute_values:
+        scan_kwargs["ExpressionAttributeValues"] = expression_attribute_values
+
+    pages = queue.Queue()
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [
+            executor.submit(
+                _scan_segment, dynamodb_client, scan_kwargs, segment, total_segments, pages
+            )
+            for segment in range(total_segments)
+        ]
+        finished = 0
+        while finished < total_segments:
+            items = pages.get()
+            if items is None:
+                finished += 1
+                continue
+            for item in items:
+                yield {key: _deserializer.deserialize(value) for key, value in item.items()}
+
+        # raises the error of a failed segment
+        for future in futures:
+            future.result()
+
+
+def iter_ce_names(dynamodb_client, total_segments: int = TOTAL_SEGMENTS):
+    """Yields the names of every cloud environment of the table."""
+    for item in iter_cloud_environments(dynamodb_client, total_segments=total_segments):
+        yield item[CE_NAME]
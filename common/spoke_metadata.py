@@ -0,0 +1,139 @@
+# -----------------------------------------------------------------
+# spoke_metadata.py
+#
+# Loads the spoke accounts of a hub DYN_METADATA table. The table is read with
+# parallel Segment / TotalSegments scans projected on the attributes the caller
+# needs, every segment follows LastEvaluatedKey to the end.
+#
+# The result is kept in an on-disk snapshot for SPOKES_CACHE_TTL seconds, so the
+# tools run one after another in the same session reuse it instead of scanning
+# the full table again. SPOKES_CACHE_TTL=0 disables the snapshot.
+#
+# Used by the tools that read the spokes, which add the common directory to sys.path.
+#
+# -----------------------------------------------------------------
+
+import os
+import json
+import hashlib
+import logging
+
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+logger = logging.getLogger(__name__)
+
+TOTAL_SEGMENTS = int(os.getenv("SPOKES_SCAN_SEGMENTS", 4))
+SPOKES_CACHE_TTL = int(os.getenv("SPOKES_CACHE_TTL", 900))
+SPOKES_CACHE_DIR = os.getenv(
+    "SPOKES_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "spoke-metadata")
+)
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def _snapshot_name(table, expression, attributes):
+    region = table.meta.client.meta.region_name
+    key = json.dumps(
+        [table.table_name, region, expression, sorted(attributes or [])],
+        default=str,
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(SPOKES_CACHE_DIR, f"{table.table_name}-{region}-{digest}.json")
+
+
+def _read_snapshot(filename, ttl_seconds):
+    try:
+        with open(filename) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time() - snapshot["fetched_at"] >= ttl_seconds:
+        return None
+    return [
+        {key: _deserializer.deserialize(value) for key, value in item.items()}
+        for item in snapshot["items"]
+    ]
+
+
+def _write_snapshot(filename, items):
+    os.makedirs(SPOKES_CACHE_DIR, exist_ok=True)
+    temp_name = f"{filename}.tmp"
+    with open(temp_name, "w") as f:
+        json.dump(
+            {
+                "fetched_at": time(),
+                "items": [
+                    {key: _serializer.serialize(value) for key, value in item.items()}
+                    for item in items
+                ],
+            },
+            f,
+        )
+    os.replace(temp_name, filename)
+
+
+def _scan_segment(dynamodb_client, scan_kwargs, segment, total_segments):
+    params = {**scan_kwargs, "Segment": segment, "TotalSegments": total_segments}
+    items = []
+    while True:
+        response = dynamodb_client.scan(**params)
+        items.extend(response.get("Items", []))
+        if not response.get("LastEvaluatedKey"):
+            return items
+        params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def load_spokes(
+    table,
+    filter_expression=None,
+    attributes=None,
+    total_segments: int = TOTAL_SEGMENTS,
+    ttl_seconds: int = SPOKES_CACHE_TTL,
+):
+    """Returns the items of the metadata table matching filter_expression.
+
+    table is a boto3 dynamodb Table, filter_expression a boto3.dynamodb.conditions
+    condition and attributes the names of the attributes to read, every attribute
+    when it is not set.
+    """
+    expression = None
+    if filter_expression is not None:
+        expression = ConditionExpressionBuilder().build_expression(filter_expression)
+    snapshot_name = _snapshot_name(table, expression, attributes)
+    if ttl_seconds > 0:
+        items = _read_snapshot(snapshot_name, ttl_seconds)
+        if items is not None:
+            logger.info(f"{len(items)} items of {table.table_name} are read from {snapshot_name}")
+            return items
+
+    # the expressions are built once, the segments pass them as strings so the
+    # condition builder of the shared table client is not used by several threads
+    scan_kwargs = {"TableName": table.table_name}
+    names = {}
+    if expression is not None:
+        scan_kwargs["FilterExpression"] = expression.condition_expression
+        names.update(expression.attribute_name_placeholders)
+        scan_kwargs["ExpressionAttributeValues"] = expression.attribute_value_placeholders
+    if attributes:
+        projection = {f"#p{index}": attribute for index, attribute in enumerate(attributes)}
+        scan_kwargs["ProjectionExpression"] = ",".join(projection)
+        names.update(projection)
+    if names:
+        scan_kwargs["ExpressionAttributeNames"] = names
+
+    # the table client still serialises the values and deserialises the items
+    dynamodb_client = table.meta.client
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        segments = executor.map(
+            lambda segment: _scan_segment(dynamodb_client, scan_kwargs, segment, total_segments),
+            range(total_segments),
+        )
+        items = [item for segment_items in segments for item in segment_items]
+
+    if ttl_seconds > 0:
+        _write_snapshot(snapshot_name, items)
+    return items
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import sys
 import logging
 import boto3
 import json
@@ -6,6 +7,10 @@ import os
 from boto3.dynamodb.conditions import Attr
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+# the modules shared by the tools of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from spoke_metadata import load_spokes  # noqa: E402
+
 
 # Set logger
 logger = logging.getLogger(__name__)
@@ -25,25 +30,7 @@ def get_active_accounts(metadata_table):
         & Attr("account-type").ne("Hub")
     )
 
-    params = {"FilterExpression": filter_expression}
-    result = []
-
-    while True:
-        response = metadata_table.scan(**params)
-
-        for item in response.get("Items", []):
-            result.append(item)
-
-        if not response.get("LastEvaluatedKey"):
-            break
-
-        params.update(
-            {
-                "ExclusiveStartKey": response["LastEvaluatedKey"],
-            }
-        )
-
-    return result
+    return load_spokes(metadata_table, filter_expression, ["account", "account-name"])
 
 
 def main(hub_name, aws_profile, batch_size=100):
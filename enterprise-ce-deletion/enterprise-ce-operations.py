@@ -13,6 +13,11 @@ from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor
 import re
 import os
+import sys
+
+# the modules shared by the tools of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from ce_enumerator import TABLE_NAME, iter_cloud_environments  # noqa: E402
 
 # Define constants for CE names , just update new environment name
 ALPHA_CE_ENV_NAMES = ["AccoutName-Tests", "AccountName-A1"]
@@ -24,6 +29,8 @@ EVERY_CE_ENV_NAMES = (
 )
 
 aws_region = os.environ.get("AWS_REGION", "us-east-2")
+# expiration updates issued at the same time per environment
+UPDATE_WORKERS = 10
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
@@ -53,33 +60,51 @@ def extract_ces(env_name, region, dry_run=False):
 
     session = get_session(env_name, region)
     if session:
-        ddb_resource = session.resource("dynamodb")
+        # the low level client, the client of the dynamodb resource converts the
+        # attribute values itself
+        ddb_client = session.client("dynamodb")
         try:
-            table = ddb_resource.Table("CLOUD-ENVIRONMENTS")
-            response = table.scan(AttributesToGet=["cloud-environment", "deleted-on"])
-            ces = [item["cloud-environment"] for item in response["Items"]]
+            # CEs named *-DELETION-* where deleted-on is empty or not set, the
+            # exact naming is checked below
+            items = iter_cloud_environments(
+                ddb_client,
+                attributes=("cloud-environment",),
+                filter_expression=(
+                    "contains(#ce, :deletion) AND (attribute_not_exists(#deleted_on)"
+                    " OR #deleted_on = :empty OR attribute_type(#deleted_on, :null))"
+                ),
+                expression_attribute_names={
+                    "#ce": "cloud-environment",
+                    "#deleted_on": "deleted-on",
+                },
+                expression_attribute_values={
+                    ":deletion": {"S": "-DELETION-"},
+                    ":empty": {"S": ""},
+                    ":null": {"S": "NULL"},
+                },
+            )
 
             # Filtering ce's with naming *deletion*
             pattern = r"^.*-DELETION-\d+$"
-            filtered_ces = [ce for ce in ces if re.match(pattern, ce)]
-
-            # Filter CEs where deleted-on is empty or not set
             filtered_ces = [
-                ce
-                for ce in filtered_ces
-                if not table.get_item(Key={"cloud-environment": ce})
-                .get("Item", {})
-                .get("deleted-on")
+                item["cloud-environment"]
+                for item in items
+                if re.match(pattern, item["cloud-environment"])
             ]
             if not dry_run:
                 # Updating expiration date for filtered ces (dry-run mode)
                 yesterday_date = datetime.now() - timedelta(days=1)
                 yesterday_date = yesterday_date.strftime("%d-%m-%Y")
-                for ce in filtered_ces:
-                    update_expiration_date(table, ce, yesterday_date)
+                with ThreadPoolExecutor(max_workers=UPDATE_WORKERS) as executor:
+                    list(
+                        executor.map(
+                            lambda ce: update_expiration_date(ddb_client, ce, yesterday_date),
+                            filtered_ces,
+                        )
+                    )
 
             return filtered_ces
-        except ddb_resource.meta.client.exceptions.ResourceNotFoundException:
+        except ddb_client.exceptions.ResourceNotFoundException:
             logger.warning(f"Table 'CLOUD-ENVIRONMENTS' not found in region {region}")
             return []
     else:
@@ -89,19 +114,20 @@ def extract_ces(env_name, region, dry_run=False):
         return []
 
 
-def update_expiration_date(table, ce_name, expiration_date):
+def update_expiration_date(ddb_client, ce_name, expiration_date):
     """
     Update the expiration field for a given Cloud Environment in the DynamoDB table.
 
-    :param table_name: The name of the DynamoDB table.
+    :param ddb_client: The DynamoDB client, shared by the concurrent updates.
     :param ce_name: The name of the Cloud Environment.
     :param expiration_date: The new expiration date.
     """
     try:
-        response = table.update_item(
-            Key={"cloud-environment": ce_name},
+        response = ddb_client.update_item(
+            TableName=TABLE_NAME,
+            Key={"cloud-environment": {"S": ce_name}},
             UpdateExpression="SET expiration = :exp",
-            ExpressionAttributeValues={":exp": expiration_date},
+            ExpressionAttributeValues={":exp": {"S": expiration_date}},
             ReturnValues="UPDATED_NEW",
         )
         logger.info(f"Updated expiration date for {ce_name} to {expiration_date}")
@@ -0,0 +1,379 @@
+# -----------------------------------------------------------------
+# benchmark.py
+#
+# Offline benchmark of the fleet extraction drivers. N accounts x M regions are
+# simulated behind the botocore before-send event with configurable per call
+# latency, throttling rate and page size, so the real clients, retries, credential
+# broker and rate limiter are exercised without any aws access.
+#
+# Every driver runs in its own process and reports the wall time, the calls per
+# second, the peak RSS and the number of throttled calls:
+#   baseline    the original extraction code, a new AssumeRole and a client of the
+#               default boto3 session for every account and region, sequentially
+#   sequential  extract_inventory.py on the current extraction_utils.py, so with
+#               the credential broker and the rate limiter, sequentially
+#   concurrent  the streaming pipeline of process_federated.py
+#
+#   python benchmark.py --accounts 100 --regions 4 --latency-ms 30 --throttle-rate 0.05
+#
+# -----------------------------------------------------------------
+
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+import resource
+import datetime
+import importlib.util
+import multiprocessing
+import threading
+
+from time import sleep, time
+from urllib.parse import parse_qs
+
+logging.basicConfig(level=logging.WARNING)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXTRACT_INVENTORY_DIR = os.path.dirname(HERE)
+
+BASELINE = "baseline"
+SEQUENTIAL = "sequential"
+CONCURRENT = "concurrent"
+DRIVERS = [BASELINE, SEQUENTIAL, CONCURRENT]
+
+EXTRACTIONS = {
+    # extraction name: (service, operation simulated for it)
+    "roles": ("iam", "ListRoles"),
+    "ssm": ("ssm", "ListDocuments"),
+    "logs": ("logs", "DescribeLogGroups"),
+}
+# the baseline and sequential drivers only support these extractions offline
+SEQUENTIAL_EXTRACTIONS = ["roles", "ssm"]
+
+
+class SimulatedAws:
+    """Answers the botocore requests of the simulated fleet from the before-send event."""
+
+    def __init__(self, latency: float, throttle_rate: float, page_size: int, items: int, seed: int = 7):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.page_size = page_size
+        self.items = items
+        self.calls = 0
+        self.throttles = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _throttled(self):
+        with self._lock:
+            self.calls += 1
+            if self._random.random() < self.throttle_rate:
+                self.throttles += 1
+                return True
+            return False
+
+    def _page(self, token):
+        start = int(token) if token else 0
+        end = min(self.items, start + self.page_size)
+        return range(start, end), (str(end) if end < self.items else None)
+
+    @staticmethod
+    def _response(request, status, body):
+        from botocore.awsrequest import AWSResponse
+
+        class Raw:
+            def stream(self, **kwargs):
+                yield body.encode()
+
+        return AWSResponse(request.url, status, {}, Raw())
+
+    def _assume_role(self, request):
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        return self._response(
+            request,
+            200,
+            "<AssumeRoleResponse><AssumeRoleResult><Credentials>"
+            "<AccessKeyId>ASIABENCHMARK</AccessKeyId><SecretAccessKey>secret</SecretAccessKey>"
+            f"<SessionToken>token</SessionToken><Expiration>{expiration.strftime('%Y-%m-%dT%H:%M:%SZ')}</Expiration>"
+            "</Credentials></AssumeRoleResult></AssumeRoleResponse>",
+        )
+
+    def _list_roles(self, request):
+        params = parse_qs(request.body.decode() if isinstance(request.body, bytes) else request.body or "")
+        items, marker = self._page(params.get("Marker", [None])[0])
+        members = "".join(
+            f"<member><Path>/</Path><RoleName>role-{one}</RoleName><RoleId>id{one}</RoleId>"
+            f"<Arn>arn:aws:iam::000000000000:role/role-{one}</Arn><CreateDate>2020-01-01T00:00:00Z</CreateDate>"
+            "<AssumeRolePolicyDocument>%7B%7D</AssumeRolePolicyDocument></member>"
+            for one in items
+        )
+        truncated = f"<IsTruncated>true</IsTruncated><Marker>{marker}</Marker>" if marker else "<IsTruncated>false</IsTruncated>"
+        return self._response(
+            request,
+            200,
+            f"<ListRolesResponse><ListRolesResult>{truncated}<Roles>{members}</Roles></ListRolesResult></ListRolesResponse>",
+        )
+
+    def _json_page(self, request, items_key, token_key, item):
+        params = json.loads(request.body or "{}")
+        items, token = self._page(params.get(token_key))
+        body = {items_key: [item(one) for one in items]}
+        if token:
+            body[token_key] = token
+        return self._response(request, 200, json.dumps(body))
+
+    def __call__(self, request, event_name, **kwargs):
+        operation = event_name.split(".")[-1]
+        if self.latency:
+            sleep(self.latency)
+
+        if operation == "AssumeRole":
+            return self._assume_role(request)
+        if self._throttled():
+            if "json" in request.headers.get("Content-Type", b"").decode():
+                return self._response(request, 400, json.dumps({"__type": "ThrottlingException", "message": "Rate exceeded"}))
+            return self._response(
+                request,
+                400,
+                "<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code><Message>Rate exceeded</Message></Error></ErrorResponse>",
+            )
+        if operation == "ListRoles":
+            return self._list_roles(request)
+        if operation == "ListDocuments":
+            return self._json_page(
+                request, "DocumentIdentifiers", "NextToken", lambda one: {"Name": f"SSM-SessionManagerRunShell-{one}"}
+            )
+        if operation == "DescribeLogGroups":
+            return self._json_page(
+                request, "logGroups", "nextToken", lambda one: {"logGroupName": f"/benchmark/{one}", "creationTime": 0}
+            )
+        raise Exception(f"the operation {operation} is not simulated")
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def hub_session(simulator):
+    import boto3
+
+    session = boto3.session.Session(
+        aws_access_key_id="hub", aws_secret_access_key="hub", region_name="eu-west-1"
+    )
+    session.events.register_last("before-send", simulator)
+    return session
+
+
+def baseline_create_client(service, role, region, hub_session):
+    """create_client of the original extraction_utils.py."""
+    import boto3
+
+    creds = hub_session.client("sts").assume_role(
+        RoleArn=role, RoleSessionName="LambdaInventorySession"
+    )
+    return boto3.client(
+        service,
+        aws_access_key_id=creds["Credentials"]["AccessKeyId"],
+        aws_secret_access_key=creds["Credentials"]["SecretAccessKey"],
+        aws_session_token=creds["Credentials"]["SessionToken"],
+        region_name=region,
+    )
+
+
+def baseline_extract_roles(session, account_id, region, max_item):
+    iam_client = baseline_create_client("iam", f"arn:aws:iam::{account_id}:role/CIP_INSPECTOR", region, session)
+    paginator = iam_client.get_paginator("list_roles")
+    return [
+        {
+            "rolename": one_role["RoleName"],
+            "Arn": one_role["Arn"],
+            "trust-relationship": one_role["AssumeRolePolicyDocument"],
+        }
+        for response in paginator.paginate(PaginationConfig={"PageSize": max_item})
+        for one_role in response["Roles"]
+    ]
+
+
+def baseline_extract_ssm_documents(session, account_id, region, doc_name="SSM-SessionManagerRunShell"):
+    ssm_client = baseline_create_client("ssm", f"arn:aws:iam::{account_id}:role/CIP_INSPECTOR", region, session)
+    paginator = ssm_client.get_paginator("list_documents")
+    return [
+        {"account_id": account_id, "region": region}
+        for response in paginator.paginate(Filters=[{"Key": "Owner", "Values": ["Self"]}])
+        for document in response["DocumentIdentifiers"]
+        if document["Name"].find(doc_name) > -1
+    ]
+
+
+def run_baseline(args, simulator, accounts, regions):
+    """The original extraction code, account by account, region by region."""
+    import boto3
+
+    session = hub_session(simulator)
+    # the spoke clients of the original code are created on the default session
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register_last("before-send", simulator)
+    assume_role_calls = [0]
+    session.events.register(
+        "before-call.sts.AssumeRole", lambda **kwargs: assume_role_calls.__setitem__(0, assume_role_calls[0] + 1)
+    )
+    extract = {
+        "roles": lambda account_id, region: baseline_extract_roles(session, account_id, region, args.page_size),
+        "ssm": lambda account_id, region: baseline_extract_ssm_documents(session, account_id, region),
+    }[args.extraction]
+
+    rows, failures = 0, 0
+    for account_id in accounts:
+        for region in regions:
+            try:
+                rows += len(extract(account_id, region) or [])
+            except Exception:
+                failures += 1
+    return rows, failures, assume_role_calls[0], 0
+
+
+def run_sequential(args, simulator, accounts, regions):
+    """Account by account, region by region, as extract_inventory.py runs on the current extraction_utils.py.
+
+    It already uses the credential broker and the rate limiter, so it is not the baseline.
+    """
+    sys.path.insert(0, EXTRACT_INVENTORY_DIR)
+    legacy = load_module("legacy_extraction_utils", os.path.join(EXTRACT_INVENTORY_DIR, "extraction_utils.py"))
+    from concurrency.credential_broker import get_broker
+    from concurrency.rate_limiter import rate_limiter
+
+    session = hub_session(simulator)
+    get_broker(session).register("before-send", simulator, last=True)
+    extract = {
+        "roles": lambda account_id, region: legacy.extract_roles(session, account_id, region, args.page_size),
+        "ssm": lambda account_id, region: legacy.extract_ssm_documents(session, account_id, region),
+    }[args.extraction]
+
+    rows, failures = 0, 0
+    for account_id in accounts:
+        for region in regions:
+            try:
+                rows += len(extract(account_id, region) or [])
+            except Exception:
+                failures += 1
+    return rows, failures, get_broker(session).assume_role_calls, rate_limiter.throttle_count()
+
+
+def run_concurrent(args, simulator, accounts, regions):
+    """The streaming pipeline of process_federated."""
+    sys.path.insert(0, HERE)
+    import extraction_utils
+    from credential_broker import get_broker
+    from pipeline import run_pipeline
+    from rate_limiter import attach_rate_limiter, rate_limiter
+
+    session = hub_session(simulator)
+    broker = get_broker(session)
+    broker.register("before-send", simulator, last=True)
+    service, _ = EXTRACTIONS[args.extraction]
+    extract = {
+        "roles": extraction_utils.extract_roles,
+        "ssm": extraction_utils.extract_ssm_documents,
+        "logs": extraction_utils.extract_log_groups,
+    }[args.extraction]
+
+    def prepare(account_id):
+        return [
+            (account_id, region, attach_rate_limiter(broker.client(service, account_id, region), account_id))
+            for region in regions
+        ]
+
+    def extraction(unit):
+        try:
+            return extract(unit), False
+        except Exception:
+            return [], True
+
+    rows, failures = 0, 0
+    for _, (result, failed) in run_pipeline(accounts, prepare, extraction, args.max_in_flight):
+        rows += len(result or [])
+        failures += failed
+    return rows, failures, broker.assume_role_calls, rate_limiter.throttle_count()
+
+
+def run_driver(driver, args, queue):
+    simulator = SimulatedAws(args.latency_ms / 1000.0, args.throttle_rate, args.page_size, args.items)
+    accounts = [f"{100000000000 + one}" for one in range(args.accounts)]
+    regions = [f"eu-west-{one + 1}" if one < 3 else f"us-east-{one - 2}" for one in range(args.regions)]
+
+    # the botocore start-up cost is not part of the measurement
+    import boto3  # noqa: F401
+
+    ts = time()
+    if driver == BASELINE:
+        rows, failures, assumed, limited = run_baseline(args, simulator, accounts, regions)
+    elif driver == SEQUENTIAL:
+        rows, failures, assumed, limited = run_sequential(args, simulator, accounts, regions)
+    else:
+        rows, failures, assumed, limited = run_concurrent(args, simulator, accounts, regions)
+    wall_time = time() - ts
+
+    queue.put(
+        {
+            "driver": driver,
+            "extraction": args.extraction,
+            "accounts": args.accounts,
+            "regions": args.regions,
+            "wall_time": round(wall_time, 3),
+            "calls": simulator.calls,
+            "calls_per_second": round(simulator.calls / wall_time, 1),
+            "throttles": simulator.throttles,
+            "limiter_throttles": limited,
+            "assume_role_calls": assumed,
+            "rows": rows,
+            "failed_units": failures,
+            # ru_maxrss is in kilobytes on linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the fleet extraction drivers.")
+    parser.add_argument("--accounts", type=int, default=50)
+    parser.add_argument("--regions", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=20, help="simulated latency of every call")
+    parser.add_argument("--throttle-rate", type=float, default=0.02, help="share of the calls answered with Throttling")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--items", type=int, default=100, help="items per account and region")
+    parser.add_argument("--extraction", choices=list(EXTRACTIONS), default="roles")
+    parser.add_argument("--drivers", default=",".join(DRIVERS))
+    parser.add_argument("--max-in-flight", type=int, default=50)
+    parser.add_argument("--output", help="write the results as json to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    context = multiprocessing.get_context("spawn")
+    results = []
+
+    for driver in args.drivers.split(","):
+        if driver in (BASELINE, SEQUENTIAL) and args.extraction not in SEQUENTIAL_EXTRACTIONS:
+            print(f"the {driver} driver does not support the {args.extraction} extraction, skipped")
+            continue
+        queue = context.Queue()
+        # a process per driver keeps the peak rss of the drivers apart
+        process = context.Process(target=run_driver, args=(driver, args, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+
+    columns = ["driver", "wall_time", "calls", "calls_per_second", "throttles", "assume_role_calls", "rows", "failed_units", "peak_rss_mb"]
+    print(" ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print(" ".join(f"{str(result[column]):>18}" for column in columns))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
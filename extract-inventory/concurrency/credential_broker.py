@@ -0,0 +1,239 @@
+# -----------------------------------------------------------------
+# credential_broker.py
+#
+# Assumes a spoke role once per (account_id, role) and hands out region specific
+# clients built from the cached credentials. The credentials are refreshed by
+# botocore shortly before they expire, so long runs keep working without
+# assuming the role again for every region and extraction type.
+#
+# Every session shares the data loader of one process wide botocore session, it
+# caches the parsed json service models, so a new client no longer reads and
+# parses the service model files again. The sessions serialise the creation of
+# their clients and resources, so they can be shared by the worker threads.
+#
+# -----------------------------------------------------------------
+
+import boto3
+import logging
+import threading
+import botocore.session
+
+from botocore.credentials import (
+    CredentialProvider,
+    CredentialResolver,
+    RefreshableCredentials,
+)
+from botocore.exceptions import ClientError
+from weakref import WeakKeyDictionary
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROLE_NAME = "CIP_INSPECTOR"
+DEFAULT_SESSION_NAME = "LambdaInventorySession"
+# refresh the credentials when less than these many seconds are left
+ADVISORY_REFRESH_SECONDS = 15 * 60
+MANDATORY_REFRESH_SECONDS = 5 * 60
+# errors that will not go away by assuming the role again
+CACHED_ERROR_CODES = ["AccessDenied", "AccessDeniedException"]
+SHARED_COMPONENTS = ["data_loader"]
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def shared_botocore_session() -> botocore.session.Session:
+    """Returns the process wide botocore session owning the shared components."""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            session = botocore.session.get_session()
+            # the components are created lazily, build them before they are shared
+            for name in SHARED_COMPONENTS:
+                session.get_component(name)
+            _shared_session = session
+        return _shared_session
+
+
+class AssumedRoleProvider(CredentialProvider):
+    """Hands the refreshable credentials of an assumed role to a botocore session."""
+
+    METHOD = "sts-assume-role"
+    CANONICAL_NAME = "custom-assume-role"
+
+    def __init__(self, credentials: RefreshableCredentials):
+        super().__init__()
+        self._refreshable_credentials = credentials
+
+    def load(self):
+        return self._refreshable_credentials
+
+
+class LockedSession(boto3.session.Session):
+    """boto3 session whose client and resource creation is serialised, so threads can share it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # resource() creates its client with client(), so the lock is reentrant
+        self._creation_lock = threading.RLock()
+
+    def client(self, *args, **kwargs):
+        with self._creation_lock:
+            return super().client(*args, **kwargs)
+
+    def resource(self, *args, **kwargs):
+        with self._creation_lock:
+            return super().resource(*args, **kwargs)
+
+
+def new_session(
+    credentials=None, profile_name: str = None, region_name: str = None
+) -> boto3.session.Session:
+    """Creates a boto3 session, for the credentials or the profile, sharing the service models of the process."""
+    botocore_session = botocore.session.Session()
+    if credentials is not None:
+        botocore_session.register_component(
+            "credential_provider", CredentialResolver([AssumedRoleProvider(credentials)])
+        )
+    session = LockedSession(
+        botocore_session=botocore_session,
+        profile_name=profile_name,
+        region_name=region_name,
+    )
+    # shared after boto3 set up its own loader, so the boto3 data path is not
+    # appended to the shared loader once per session
+    shared = shared_botocore_session()
+    for name in SHARED_COMPONENTS:
+        botocore_session.register_component(name, shared.get_component(name))
+    return session
+
+
+class CredentialBroker:
+    """Caches assumed role sessions per (account_id, role) for a hub session."""
+
+    def __init__(
+        self,
+        hub_session: boto3.session.Session,
+        session_name: str = DEFAULT_SESSION_NAME,
+    ):
+        self._session_name = session_name
+        self._sts_client = hub_session.client("sts")
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._sessions = {}
+        self._failures = {}
+        self._handlers = []
+        self.assume_role_calls = 0
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _assume_role(self, role_arn: str):
+        with self._lock:
+            self.assume_role_calls += 1
+        creds = self._sts_client.assume_role(
+            RoleArn=role_arn, RoleSessionName=self._session_name
+        )["Credentials"]
+        return {
+            "access_key": creds["AccessKeyId"],
+            "secret_key": creds["SecretAccessKey"],
+            "token": creds["SessionToken"],
+            "expiry_time": creds["Expiration"].isoformat(),
+        }
+
+    def session(self, account_id: str, role_name: str = DEFAULT_ROLE_NAME):
+        """Returns the boto3 session of the role, assuming it on first use."""
+        key = (account_id, role_name)
+        if key in self._sessions:
+            return self._sessions[key]
+
+        with self._key_lock(key):
+            if key in self._sessions:
+                return self._sessions[key]
+            if key in self._failures:
+                raise self._failures[key]
+
+            role_arn = f"arn:aws:iam::{account_id}:role/{role_name}"
+            try:
+                credentials = RefreshableCredentials.create_from_metadata(
+                    metadata=self._assume_role(role_arn),
+                    refresh_using=lambda: self._assume_role(role_arn),
+                    method="sts-assume-role",
+                    advisory_timeout=ADVISORY_REFRESH_SECONDS,
+                    mandatory_timeout=MANDATORY_REFRESH_SECONDS,
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] in CACHED_ERROR_CODES:
+                    self._failures[key] = err
+                raise err
+
+            session = new_session(credentials)
+            with self._lock:
+                for event_name, handler, last in self._handlers:
+                    self._register(session, event_name, handler, last)
+                self._sessions[key] = session
+            logger.info(f"the role {role_arn} is assumed")
+
+        return self._sessions[key]
+
+    @staticmethod
+    def _register(session, event_name, handler, last):
+        if last:
+            session.events.register_last(event_name, handler)
+        else:
+            session.events.register(event_name, handler)
+
+    def register(self, event_name: str, handler, last: bool = False):
+        """Registers a botocore event handler on every session and so every client of the broker."""
+        with self._lock:
+            self._handlers.append((event_name, handler, last))
+            for session in self._sessions.values():
+                self._register(session, event_name, handler, last)
+
+    def client(
+        self,
+        service: str,
+        account_id: str,
+        region: str,
+        role_name: str = DEFAULT_ROLE_NAME,
+    ):
+        """Creates a BOTO3 client for the region using the cached credentials."""
+        return self.session(account_id, role_name).client(service, region_name=region)
+
+
+_brokers = WeakKeyDictionary()
+_brokers_lock = threading.Lock()
+
+
+def get_broker(hub_session: boto3.session.Session) -> CredentialBroker:
+    """Returns the broker shared by every caller of the same hub session."""
+    with _brokers_lock:
+        if hub_session not in _brokers:
+            _brokers[hub_session] = CredentialBroker(hub_session)
+        return _brokers[hub_session]
+
+
+def split_role_arn(role_arn: str):
+    """Splits arn:aws:iam::<account_id>:role/<role_name> into its parts."""
+    account_id = role_arn.split(":")[4]
+    role_name = role_arn[role_arn.find(":role/") + len(":role/"):]
+    return account_id, role_name
+
+
+_profile_sessions = {}
+_profile_sessions_lock = threading.Lock()
+
+
+def get_profile_session(profile_name: str, region: str) -> boto3.session.Session:
+    """Returns one cached boto3 session per (profile, region) for profile based runs.
+
+    The session is shared by the threads of the run, it serialises the creation of
+    its clients and resources.
+    """
+    key = (profile_name, region)
+    with _profile_sessions_lock:
+        if key not in _profile_sessions:
+            _profile_sessions[key] = new_session(
+                profile_name=profile_name, region_name=region
+            )
+        return _profile_sessions[key]
@@ -0,0 +1,190 @@
+# -----------------------------------------------------------------
+# instrumentation.py
+#
+# Opt-in per api call telemetry of the extraction clients. The botocore
+# before-call, after-call, after-call-error and needs-retry events of every
+# instrumented client feed latency histograms, retry, throttle and error counts
+# per (service, operation, region).
+#
+# Set API_METRICS_FILE to enable it, the metrics are written at the end of the
+# run as json, or as a Prometheus text file when the name ends with .prom
+#
+# -----------------------------------------------------------------
+
+import os
+import json
+import logging
+import threading
+
+from time import monotonic
+
+try:
+    from .rate_limiter import THROTTLING_ERROR_CODES
+except ImportError:
+    # run as a script of the concurrency directory
+    from rate_limiter import THROTTLING_ERROR_CODES
+
+logger = logging.getLogger(__name__)
+
+API_METRICS_FILE = os.getenv("API_METRICS_FILE")
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+START_KEY = "instrumentation_start"
+
+
+class OperationMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.latency_sum = 0.0
+        # the last bucket counts the calls slower than every bound
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, latency: float, retries: int, failed: bool):
+        self.calls += 1
+        self.errors += failed
+        self.retries += retries
+        self.latency_sum += latency
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+
+class ApiMetrics:
+    """Aggregates the telemetry of the instrumented clients per (service, operation, region)."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _operation(self, key) -> OperationMetrics:
+        if key not in self._metrics:
+            self._metrics[key] = OperationMetrics()
+        return self._metrics[key]
+
+    def attach(self, client):
+        """Registers the telemetry handlers on the client."""
+        if client is None:
+            return client
+
+        service = client.meta.service_model.service_name
+        region = client.meta.region_name
+
+        def before_call(context, **kwargs):
+            context[START_KEY] = monotonic()
+
+        def observe(model, context, retries, failed):
+            latency = monotonic() - context.get(START_KEY, monotonic())
+            with self._lock:
+                self._operation((service, model.name, region)).observe(
+                    latency, retries, failed
+                )
+
+        def after_call(model, parsed, context, **kwargs):
+            retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+            observe(model, context, retries, "Error" in parsed)
+
+        def after_call_error(context, exception, event_name, **kwargs):
+            latency = monotonic() - context.get(START_KEY, monotonic())
+            retries = (
+                getattr(exception, "response", {})
+                .get("ResponseMetadata", {})
+                .get("RetryAttempts", 0)
+            )
+            with self._lock:
+                self._operation((service, event_name.split(".")[-1], region)).observe(
+                    latency, retries, True
+                )
+
+        def needs_retry(operation, response=None, **kwargs):
+            if response is not None:
+                code = response[1].get("Error", {}).get("Code")
+                if code in THROTTLING_ERROR_CODES:
+                    with self._lock:
+                        self._operation((service, operation.name, region)).throttles += 1
+
+        client.meta.events.register("before-call", before_call)
+        client.meta.events.register("after-call", after_call)
+        client.meta.events.register("after-call-error", after_call_error)
+        client.meta.events.register("needs-retry", needs_retry)
+        return client
+
+    def rows(self):
+        with self._lock:
+            items = sorted(self._metrics.items())
+        return [
+            {
+                "service": service,
+                "operation": operation,
+                "region": region,
+                "calls": metrics.calls,
+                "errors": metrics.errors,
+                "retries": metrics.retries,
+                "throttles": metrics.throttles,
+                "latency_sum": round(metrics.latency_sum, 6),
+                "latency_buckets": dict(
+                    zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], metrics.buckets)
+                ),
+            }
+            for (service, operation, region), metrics in items
+        ]
+
+    @staticmethod
+    def _prometheus(rows):
+        lines = [
+            "# HELP aws_api_call_duration_seconds Latency of the aws api calls including retries.",
+            "# TYPE aws_api_call_duration_seconds histogram",
+        ]
+        for row in rows:
+            labels = f'service="{row["service"]}",operation="{row["operation"]}",region="{row["region"]}"'
+            cumulative = 0
+            for bound, count in row["latency_buckets"].items():
+                cumulative += count
+                lines.append(f'aws_api_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"aws_api_call_duration_seconds_sum{{{labels}}} {row['latency_sum']}")
+            lines.append(f"aws_api_call_duration_seconds_count{{{labels}}} {row['calls']}")
+        for name, field, description in [
+            ("aws_api_call_errors_total", "errors", "Failed aws api calls."),
+            ("aws_api_call_retries_total", "retries", "Retried attempts of the aws api calls."),
+            ("aws_api_call_throttles_total", "throttles", "Throttled attempts of the aws api calls."),
+        ]:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for row in rows:
+                labels = f'service="{row["service"]}",operation="{row["operation"]}",region="{row["region"]}"'
+                lines.append(f"{name}{{{labels}}} {row[field]}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filename: str):
+        """Writes the metrics to the file and logs the operations that took the longest."""
+        rows = self.rows()
+        with open(filename, "w") as f:
+            if filename.endswith(".prom"):
+                f.write(self._prometheus(rows))
+            else:
+                json.dump(rows, f, indent=2)
+
+        for row in sorted(rows, key=lambda x: x["latency_sum"], reverse=True)[:10]:
+            logger.info(
+                f"{row['service']}.{row['operation']} in {row['region']}: {row['calls']} calls "
+                f"in {row['latency_sum']:.1f} seconds, {row['retries']} retries, {row['throttles']} throttles"
+            )
+        logger.info(f"the api metrics are written to {filename}")
+
+
+api_metrics = ApiMetrics()
+
+
+def instrument(client):
+    """Attaches the shared metrics to the client when API_METRICS_FILE is set."""
+    if API_METRICS_FILE:
+        api_metrics.attach(client)
+    return client
+
+
+def dump_api_metrics():
+    if API_METRICS_FILE:
+        api_metrics.dump(API_METRICS_FILE)
@@ -0,0 +1,93 @@
+# -----------------------------------------------------------------
+# journal.py
+#
+# Append-only resume journal of the completed (account, region, extraction type)
+# units and their result rows. Every completed unit is written as one json line
+# and flushed to disk, so a restarted run skips what is already done and the
+# report is built from the journal as one merged file.
+#
+# -----------------------------------------------------------------
+
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ResumeJournal:
+    """Durable record of the extraction units completed by previous and current runs."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._completed = set()
+        self._load()
+        self._file = open(self.filename, "a")
+        if self._file.tell() > 0 and not self._ends_with_newline():
+            self._file.write("\n")
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line is cut when the run is killed while writing it
+                    logger.warning(f"skipping the incomplete journal line: {line[:100]}")
+                    continue
+                self._completed.add(
+                    (entry["account_id"], entry["region"], entry["extraction_type"])
+                )
+        logger.info(
+            f"{len(self._completed)} completed units are loaded from {self.filename}"
+        )
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.filename, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def is_completed(self, account_id: str, region: str, extraction_type: int) -> bool:
+        return (account_id, region, extraction_type) in self._completed
+
+    def record(self, account_id: str, region: str, extraction_type: int, rows):
+        """Appends the unit with its rows and flushes it to disk."""
+        line = json.dumps(
+            {
+                "account_id": account_id,
+                "region": region,
+                "extraction_type": extraction_type,
+                "rows": rows or [],
+            },
+            default=str,
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._completed.add((account_id, region, extraction_type))
+
+    def rows(self, extraction_type: int):
+        """Yields every journaled row of the extraction type."""
+        with self._lock:
+            self._file.flush()
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry["extraction_type"] == extraction_type:
+                    yield from entry["rows"]
+
+    def close(self, remove: bool = False):
+        """Closes the journal, removing it once the report has been written."""
+        with self._lock:
+            self._file.close()
+        if remove:
+            os.remove(self.filename)
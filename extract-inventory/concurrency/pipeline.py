@@ -0,0 +1,66 @@
+# -----------------------------------------------------------------
+# pipeline.py
+#
+# Streams work items through a preparation stage (client creation) and an
+# extraction stage on one bounded thread pool. Up to max_in_flight tasks run at
+# any time, a slow extraction only holds its own slot, and every result is
+# yielded as soon as it completes instead of waiting for a whole page.
+#
+# -----------------------------------------------------------------
+
+import logging
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+PREPARE = "prepare"
+EXTRACT = "extract"
+PROGRESS_EVERY = 100
+
+
+def run_pipeline(items, prepare, extract, max_in_flight: int = 200):
+    """Yields (unit, result) for every unit returned by prepare(item) once extract(unit) is done."""
+    items = iter(items)
+    ready_units = deque()
+    in_flight = {}
+    prepared = 0
+    completed = 0
+
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def fill():
+        while len(in_flight) < max_in_flight:
+            # drain the prepared units first to keep the number of open clients low
+            if ready_units:
+                unit = ready_units.popleft()
+                in_flight[executor.submit(extract, unit)] = (EXTRACT, unit)
+                continue
+            item = next(items, None)
+            if item is None:
+                break
+            in_flight[executor.submit(prepare, item)] = (PREPARE, item)
+
+    try:
+        fill()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, arg = in_flight.pop(future)
+                if stage == PREPARE:
+                    prepared += 1
+                    ready_units.extend(future.result() or [])
+                else:
+                    completed += 1
+                    if completed % PROGRESS_EVERY == 0:
+                        logger.info(
+                            f"{completed} extractions completed, {prepared} items prepared, "
+                            f"{len(in_flight) + len(ready_units)} extractions waiting"
+                        )
+                    yield arg, future.result()
+            fill()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    logger.info(f"{completed} extractions completed for {prepared} prepared items")
@@ -3,25 +3,32 @@
 #
 # Extracts resources from enterprise environments based on the cloud environments
 # Update TARGET_ENVS to define the environment to be extracted
-# Adjust SUBMIT_LIMIT_PER_FETCH to optimize your local machine resources and to avoid throttling
+# Adjust MAX_IN_FLIGHT to optimize your local machine resources and to avoid throttling
 #
 # -----------------------------------------------------------------
 
-import boto3
+import os
+import sys
 import logging
 import datetime
 import botocore
-import itertools
 import extraction_utils
 
 from csv import reader as csv_reader
 
-from math import ceil as math_ceil
 from pandas import DataFrame
 from typing import Final
 from functools import wraps
 from time import time
-from concurrent.futures import ThreadPoolExecutor
+from credential_broker import get_profile_session
+from instrumentation import dump_api_metrics, instrument
+from pipeline import run_pipeline
+from report_writer import ShardedReportWriter
+from rate_limiter import attach_rate_limiter, rate_limiter
+
+# the modules shared by the tools of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "common"))
+from ce_enumerator import iter_ce_names  # noqa: E402
 
 EXTRACT_CE_RESOURCES: Final = 111
 EXTRACT_CE_INSTANCES: Final = 112
@@ -39,7 +46,8 @@ SERVICE_MAP = {
     EXTRACT_CE_ASGS: "autoscaling",
 }
 
-SUBMIT_LIMIT_PER_FETCH = 50
+# number of client preparations and extractions running at the same time
+MAX_IN_FLIGHT = 50
 
 ALPHA_CE_NAMES: Final = ["AccountName-A1"]
 BETA_CE_NAMES: Final = ["AccountName-U1", "AccountName"]
@@ -62,10 +70,10 @@ TARGET_ENVS = NON_PROD_NAMES
 def get_session(ce_name, region):
     PROFILE = f"{ce_name}-role_DEVOPS"
     try:
-        dev_session = boto3.session.Session(profile_name=PROFILE, region_name=region)
+        dev_session = get_profile_session(PROFILE, region)
     except botocore.exceptions.ProfileNotFound:
         PROFILE = f"{ce_name}-role_DEVOPS"
-        dev_session = boto3.session.Session(profile_name=PROFILE, region_name=region)
+        dev_session = get_profile_session(PROFILE, region)
 
     logger.info(f"profile name: {PROFILE}")
     return dev_session
@@ -98,17 +106,9 @@ def get_ce_envs(_env_name, _region: str = "eu-west-1"):
         data = read_accounts_from_file(f"{_env_name}_ce_names.csv")
 
     except FileNotFoundError:
-        ddb_resource = dev_session.resource("dynamodb", region_name=_region).Table(
-            "CLOUD-ENVIRONMENTS"
-        )
-
-        response = ddb_resource.scan(
-            AttributesToGet=[
-                "cloud-environment",
-            ],
-            Select="SPECIFIC_ATTRIBUTES",
+        data = sorted(
+            iter_ce_names(dev_session.client("dynamodb", region_name=_region))
         )
-        data = sorted([item["cloud-environment"] for item in response["Items"]])
 
         DataFrame(data, columns=["ce_name"]).to_csv(
             f"ce_names_{_env_name}_{_region}.csv", index=False
@@ -160,74 +160,46 @@ def extraction(all_args):
         raise Exception("no proper option was given")
 
 
+def initialize_clients(env):
+    region = "eu-west-1" if env[0:3] == "AccountName" else "us-east-2"
+
+    spoke_client = instrument(
+        attach_rate_limiter(
+            get_session(env, region).client(SERVICE_MAP[EXTRACTION_TYPE]), env
+        )
+    )
+
+    if EXTRACTION_TYPE == EXTRACT_CE_RESOURCES:
+        return [
+            (item, region, spoke_client, EXTRACTION_TYPE)
+            for item in get_ce_envs(env, region)
+        ]
+    return [(env, region, spoke_client, EXTRACTION_TYPE)]
+
+
 if __name__ == "__main__":
     ts = time()
 
-    ce_names = []
-
-    for env in TARGET_ENVS:
-        region = "eu-west-1" if env[0:3] == "AccountName" else "us-east-2"
-
-        spoke_client = get_session(env, region).client(SERVICE_MAP[EXTRACTION_TYPE])
-
-        if EXTRACTION_TYPE == EXTRACT_CE_RESOURCES:
-            temp = get_ce_envs(env, region)
-            ce_names.extend(
-                [(item, region, spoke_client, EXTRACTION_TYPE) for item in temp]
-            )
-        else:
-            ce_names.extend([(env, region, spoke_client, EXTRACTION_TYPE)])
-
-    with ThreadPoolExecutor() as result_executor:
-        results = []
-        total_accounts = len(ce_names)
-        num_of_pages = math_ceil(total_accounts / float(SUBMIT_LIMIT_PER_FETCH))
-
-        for one in range(1, num_of_pages + 1):
-            offset = (one - 1) * SUBMIT_LIMIT_PER_FETCH
-            logger.info(f"the %{(one / num_of_pages) * 100} percent completed")
-            try:
-                results.extend(
-                    list(
-                        itertools.chain.from_iterable(
-                            [
-                                result
-                                for result in result_executor.map(
-                                    extraction,
-                                    ce_names[offset: offset + SUBMIT_LIMIT_PER_FETCH],
-                                )
-                                if result and len(result) > 0
-                            ]
-                        )
-                    )
-                )
-            except Exception as ex:
-                function_reports = sorted(
-                    results,
-                    key=lambda x: x[key_word_to_sort(EXTRACTION_TYPE)],
-                    reverse=False,
-                )
-                df = DataFrame(function_reports)
-                df.to_csv(
-                    f"{key_word_to_sort(EXTRACTION_TYPE)}_{'_'.join(TARGET_ENVS)}_{tag_date()}.csv",
-                    index=False,
-                )
-                raise ex
+    report = ShardedReportWriter(
+        f"{key_word_to_sort(EXTRACTION_TYPE)}_{'_'.join(TARGET_ENVS)}_{tag_date()}.csv",
+        key_word_to_sort(EXTRACTION_TYPE),
+    )
+    try:
+        for _, result in run_pipeline(
+            TARGET_ENVS, initialize_clients, extraction, MAX_IN_FLIGHT
+        ):
+            report.write(result)
+    except Exception as ex:
+        report.close()
+        raise ex
 
     tr = time()
     logger.info(f"fetching results is completed in {tr - ts} seconds")
 
-    function_reports = sorted(
-        results,
-        key=lambda x: x[key_word_to_sort(EXTRACTION_TYPE)],
-        reverse=False,
-    )
-    df = DataFrame(function_reports)
-    df.to_csv(
-        f"{key_word_to_sort(EXTRACTION_TYPE)}_{'_'.join(TARGET_ENVS)}_{tag_date()}.csv",
-        index=False,
-    )
+    report.close()
     te = time()
     logger.info(
         f"extraction type is {EXTRACTION_TYPE} for {'_'.join(TARGET_ENVS)} completed in {te-ts} seconds"
     )
+    rate_limiter.report()
+    dump_api_metrics()
@@ -3,18 +3,22 @@ import boto3
 import logging
 import datetime
 import botocore
-import itertools
 import extraction_utils
 
 from csv import reader as csv_reader
 from hs_service.aws.dynamodb import DynamoDB
 from boto3.dynamodb.conditions import Attr
-from math import ceil as math_ceil
 from pandas import DataFrame
 from typing import Final
 from functools import wraps
 from time import time
-from concurrent.futures import ThreadPoolExecutor
+from credential_broker import DEFAULT_ROLE_NAME, get_broker
+from instrumentation import dump_api_metrics, instrument
+from journal import ResumeJournal
+from pipeline import run_pipeline
+from report_writer import ShardedReportWriter
+from rate_limiter import attach_rate_limiter, rate_limiter
+from region_cache import RegionCache, describe_enabled_regions
 
 EXTRACT_LAMBDAS: Final = 1
 EXTRACT_ROLES: Final = 2
@@ -38,6 +42,10 @@ EXTRACT_AM: Final = 19
 EXTRACT_USER_PROFILE: Final = 20
 EXTRACT_AMI_BLOCK_PUBLIC_ACCESS: Final = 21
 EXTRACTION_TYPE: Final = EXTRACT_AMI_BLOCK_PUBLIC_ACCESS
+# comma separated extraction types collected in a single pass, e.g. EXTRACTION_TYPES="2,6,16"
+EXTRACTION_TYPES: Final = sorted(
+    {int(one) for one in os.getenv("EXTRACTION_TYPES", str(EXTRACTION_TYPE)).split(",")}
+)
 
 SERVICE_MAP = {
     EXTRACT_LAMBDAS: "lambda",
@@ -62,8 +70,8 @@ SERVICE_MAP = {
     EXTRACT_AMI_BLOCK_PUBLIC_ACCESS: "ec2",
 }
 
-SUBMIT_LIMIT_PER_PREP = 200
-SUBMIT_LIMIT_PER_FETCH = 200
+# number of client preparations and extractions running at the same time
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", 200))
 
 MAX_ITEM: Final = os.getenv("PAGE_LIMIT", 50)
 ARE_SPOKES_INCLUDED: Final = os.getenv(
@@ -91,6 +99,8 @@ KEY_TAG_NAME = "cip-"
 SPECIFIC_ACCOUNT = "495416159460"
 EXTRACT_TAGS_RESOURCE_TYPE = os.getenv("EXTRACT_TAGS_RESOURCE_TYPE", "EC2")
 RESUME_EXTRACTION = os.getenv("RESUME_EXTRACTION", "NO")
+DISCOVER_REGIONS = os.getenv("DISCOVER_REGIONS", "NO")  # YES: skip the disabled regions
+REGION_CACHE_TTL_HOURS = float(os.getenv("REGION_CACHE_TTL_HOURS", 24))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -111,6 +121,16 @@ except botocore.exceptions.ProfileNotFound:
 
 logger.info(f"profile name: {PROFILE}")
 
+# the enabled regions of every account are discovered once and reused until the ttl expires
+region_cache = (
+    RegionCache(f"regions_{HUB_NAMES}.json", REGION_CACHE_TTL_HOURS * 3600)
+    if DISCOVER_REGIONS.lower() == "yes"
+    else None
+)
+
+# completed units of an interrupted run are skipped, the journal is removed after the report is written
+journal = ResumeJournal(f"journal_{HUB_NAMES}_{ACCOUNT_TYPE}_{ENVIRONMENT_TYPE}.jsonl")
+
 
 def timing(f):
     @wraps(f)
@@ -241,22 +261,16 @@ def create_client(
 ):
     """Creates a BOTO3 client using the correct target accounts Role."""
     try:
-        sts_client = hub_session.client("sts")
-        role = f"arn:aws:iam::{account_id}:role/CIP_INSPECTOR"
-        creds = sts_client.assume_role(
-            RoleArn=role, RoleSessionName="LambdaInventorySession"
-        )
-
-        client = boto3.client(
-            service,
-            aws_access_key_id=creds["Credentials"]["AccessKeyId"],
-            aws_secret_access_key=creds["Credentials"]["SecretAccessKey"],
-            aws_session_token=creds["Credentials"]["SessionToken"],
-            region_name=region,
+        client = instrument(
+            attach_rate_limiter(
+                get_broker(hub_session).client(service, account_id, region), account_id
+            )
         )
     except Exception as err:
         logger.error(err, exc_info=True)
-        logger.critical(f"Client error occurred:{err} for role {role}")
+        logger.critical(
+            f"Client error occurred:{err} for role arn:aws:iam::{account_id}:role/{DEFAULT_ROLE_NAME}"
+        )
         return None
 
     return client
@@ -305,131 +319,125 @@ def extraction(all_args):
 
 
 @timing
-def build_accounts(_dev_session, client_type, extraction_type):
+def build_accounts(_dev_session, extraction_types):
     _accounts = [
-        (a, b.split("#")[0], client_type, extraction_type)
-        for a, b in get_account_ids().items()
+        (a, b.split("#")[0], extraction_types) for a, b in get_account_ids().items()
     ]
 
     return _accounts
 
 
-def initialize_clients(initial_param):
-    account_id, region, client_type, extraction_type = initial_param
-    print(f"Initialize_Client = account_id: {account_id}, region: {region}, client_type: {client_type}")
-    region_pop = False
-    # make sure no stone is left untouched
+def discover_regions(account_id, region):
+    ec2_client = create_client("ec2", account_id, region, dev_session)
+    if ec2_client is None:
+        return None
+    try:
+        return describe_enabled_regions(ec2_client)
+    except Exception as err:
+        logger.warning(f"cannot discover the regions of {account_id} because of {err}")
+        return None
+
 
+def target_regions(account_id, region, client_type):
+    regions = REGIONS
+    # make sure no stone is left untouched
     if region not in REGIONS and client_type != "iam":
         logger.info(f"the region {region} added for the account id {account_id}")
-        REGIONS.append(region)
-        region_pop = True
-
-    temp = [
-        (
-            account_id,
-            one_region,
-            create_client(
-                client_type,
-                account_id,
-                one_region,
-                dev_session,
-            ),
-            extraction_type,
+        regions = REGIONS + [region]
+
+    if region_cache is None:
+        return regions
+
+    enabled = region_cache.enabled_regions(
+        account_id, lambda: discover_regions(account_id, region)
+    )
+    if enabled is None:
+        return regions
+    skipped = [one for one in regions if one not in enabled]
+    if skipped:
+        logger.info(f"the disabled regions {skipped} are skipped for the account id {account_id}")
+    return [one for one in regions if one in enabled]
+
+
+def initialize_clients(initial_param):
+    account_id, region, extraction_types = initial_param
+    print(f"Initialize_Client = account_id: {account_id}, region: {region}, extraction_types: {extraction_types}")
+
+    temp = []
+    for extraction_type in extraction_types:
+        client_type = SERVICE_MAP[extraction_type]
+        regions = target_regions(account_id, region, client_type)
+
+        temp.extend(
+            [
+                (
+                    account_id,
+                    one_region,
+                    create_client(
+                        client_type,
+                        account_id,
+                        one_region,
+                        dev_session,
+                    ),
+                    extraction_type,
+                )
+                for one_region in regions
+                if not journal.is_completed(account_id, one_region, extraction_type)
+            ]
         )
-        for one_region in REGIONS
-    ]
 
-    if region_pop:
-        logger.info(f"the region {region} removed for the account id {account_id}")
-        REGIONS.pop()
     return temp
 
 
 if __name__ == "__main__":
     ts = time()
-    accounts = build_accounts(
-        dev_session, SERVICE_MAP[EXTRACTION_TYPE], EXTRACTION_TYPE
-    )
+    unsupported_types = [one for one in EXTRACTION_TYPES if one not in SERVICE_MAP]
+    if unsupported_types:
+        raise Exception(f"unsupported extraction types: {unsupported_types}")
+
+    accounts = build_accounts(dev_session, EXTRACTION_TYPES)
     total_accounts = len(accounts)
-    num_of_pages = math_ceil(total_accounts / float(SUBMIT_LIMIT_PER_PREP))
     logger.info(
         f"the total number of accounts to be initialized for all regions: {total_accounts}"
     )
 
-    with ThreadPoolExecutor() as prep_executor:
-        preps = []
-        for one in range(1, num_of_pages + 1):
-            offset = (one - 1) * SUBMIT_LIMIT_PER_PREP
-            logger.info(f"the %{(one / num_of_pages)*100} percent prepared")
-            for result in prep_executor.map(
-                initialize_clients, accounts[offset: offset + SUBMIT_LIMIT_PER_PREP]
-            ):
-                if result and len(result) > 0:
-                    preps.extend(result)
-
-    tp = time()
-    logger.info(f"preparation is completed in {tp - ts} seconds")
-
-    with ThreadPoolExecutor() as result_executor:
-        results = []
-        total_accounts = len(preps)
-        num_of_pages = math_ceil(total_accounts / float(SUBMIT_LIMIT_PER_FETCH))
-
-        for one in range(1, num_of_pages + 1):
-            offset = (one - 1) * SUBMIT_LIMIT_PER_FETCH
-            logger.info(f"the %{(one / num_of_pages) * 100} percent completed")
-            try:
-                results.extend(
-                    list(
-                        itertools.chain.from_iterable(
-                            [
-                                result
-                                for result in result_executor.map(
-                                    extraction,
-                                    preps[offset: offset + SUBMIT_LIMIT_PER_FETCH],
-                                )
-                                if result and len(result) > 0
-                            ]
-                        )
-                    )
-                )
-            except Exception as ex:
-                function_reports = sorted(
-                    results,
-                    key=lambda x: x[key_word_to_sort(EXTRACTION_TYPE)],
-                    reverse=False,
-                )
-                df = DataFrame(function_reports)
-                df.to_csv(
-                    f"{key_word_to_sort(EXTRACTION_TYPE)}_{HUB_NAMES}_ALL_{ACCOUNT_TYPE}_{ENVIRONMENT_TYPE}_{tag_date()}.csv",
-                    index=False,
-                )
-                raise ex
+    try:
+        for unit, result in run_pipeline(
+            accounts, initialize_clients, extraction, MAX_IN_FLIGHT
+        ):
+            account_id, region, session_client, extraction_type = unit
+            # units without a client failed to assume the role and are retried on the next run
+            if session_client is not None:
+                journal.record(account_id, region, extraction_type, result)
+    except Exception as ex:
+        logger.error(
+            f"the run is stopped, rerun the script to resume from the journal {journal.filename}"
+        )
+        raise ex
 
     tr = time()
     logger.info(f"fetching results is completed in {tr - ts} seconds")
 
-    function_reports = sorted(
-        results,
-        key=lambda x: x[key_word_to_sort(EXTRACTION_TYPE)],
-        reverse=False,
-    )
     _accounts_dict = read_accounts_from_file(f"accounts_{HUB_NAMES}.csv")
 
-    append_account_type = [
-        dict(
-            customer,
-            **{"account-type": _accounts_dict[customer["account_id"]].split("#")[1]},
+    for extraction_type in EXTRACTION_TYPES:
+        report = ShardedReportWriter(
+            f"{key_word_to_sort(extraction_type)}_{extraction_type}_{HUB_NAMES}_ALL_{ACCOUNT_TYPE}_{ENVIRONMENT_TYPE}_{tag_date()}.csv",
+            key_word_to_sort(extraction_type),
         )
-        for customer in function_reports
-    ]
-    df = DataFrame(append_account_type)
-    df.to_csv(
-        f"{key_word_to_sort(EXTRACTION_TYPE)}_{HUB_NAMES}_ALL_{ACCOUNT_TYPE}_{ENVIRONMENT_TYPE}_{tag_date()}.csv",
-        index=False,
-    )
+        report.write(
+            dict(
+                customer,
+                **{"account-type": _accounts_dict[customer["account_id"]].split("#")[1]},
+            )
+            for customer in journal.rows(extraction_type)
+        )
+        report.close()
+    journal.close(remove=True)
     te = time()
     logger.info(
-        f"extraction type is {EXTRACTION_TYPE} for {HUB_NAMES} completed in {te-ts} seconds"
+        f"extraction types {EXTRACTION_TYPES} for {HUB_NAMES} completed in {te-ts} seconds"
     )
+    logger.info(f"the number of assumed roles: {get_broker(dev_session).assume_role_calls}")
+    rate_limiter.report()
+    dump_api_metrics()
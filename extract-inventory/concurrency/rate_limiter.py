@@ -0,0 +1,174 @@
+# -----------------------------------------------------------------
+# rate_limiter.py
+#
+# Adaptive token bucket per (service, region, account) for the extraction clients.
+# A bucket lets the calls through unpaced until its first throttling response,
+# from then on every request of an attached client takes a token from it. The
+# bucket reacts to throttling responses with AIMD: the rate is cut sharply on a
+# throttle and ramps up again by a small step per second of successful calls, so
+# a run settles at the highest throughput the APIs accept. The buckets capped
+# with a max_rate pace their calls from the first one.
+#
+# -----------------------------------------------------------------
+
+import os
+import logging
+import threading
+
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+INITIAL_RATE = float(os.getenv("RATE_LIMIT_INITIAL", 10))  # requests per second
+MIN_RATE = float(os.getenv("RATE_LIMIT_MIN", 0.5))
+MAX_RATE = float(os.getenv("RATE_LIMIT_MAX", 100))
+DECREASE_FACTOR = 0.5  # multiplicative decrease on throttling
+INCREASE_STEP = 1.0  # additive increase per second of successful calls
+# throttles reported within this window belong to the same burst and cut the rate once
+DECREASE_WINDOW_SECONDS = 1.0
+
+THROTTLING_ERROR_CODES = [
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "RequestThrottled",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "BandwidthLimitExceeded",
+    "SlowDown",
+    "LimitExceededException",
+]
+
+
+class TokenBucket:
+    """Token bucket whose refill rate follows additive increase, multiplicative decrease, up to max_rate."""
+
+    def __init__(self, rate: float = INITIAL_RATE, max_rate: float = MAX_RATE):
+        self.max_rate = max_rate
+        self.rate = min(rate, max_rate)
+        self.throttles = 0
+        # no pacing before the first throttle, unless the bucket is capped
+        self.limited = max_rate < MAX_RATE
+        # the bucket starts full
+        self._tokens = max(self.rate, 1.0)
+        # the unpaced calls, their rate is where the pacing starts
+        self._calls = 0
+        self._first_call = None
+        self._last_refill = monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # the capacity is one second worth of calls
+        self._tokens = min(
+            max(self.rate, 1.0), self._tokens + (now - self._last_refill) * self.rate
+        )
+        self._last_refill = now
+
+    def acquire(self):
+        if not self.limited:
+            with self._lock:
+                if self._first_call is None:
+                    self._first_call = monotonic()
+                self._calls += 1
+            return
+        while True:
+            with self._lock:
+                self._refill(monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            sleep(wait_seconds)
+
+    def on_success(self):
+        if not self.limited:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + INCREASE_STEP / self.rate)
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttles += 1
+            now = monotonic()
+            if not self.limited:
+                # the pacing starts now, at half the rate the calls were sent at
+                self.limited = True
+                self._last_refill = now
+                if self._first_call is not None and now > self._first_call:
+                    self.rate = min(self.max_rate, max(MIN_RATE, self._calls / (now - self._first_call)))
+            if now - self._last_decrease >= DECREASE_WINDOW_SECONDS:
+                self._last_decrease = now
+                self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+                self._tokens = min(self._tokens, 0.0)
+
+
+class AdaptiveRateLimiter:
+    """Keeps one token bucket per (service, region, account)."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service: str, region: str, account_id: str, max_rate: float = MAX_RATE) -> TokenBucket:
+        """Returns the bucket of the key, max_rate applies when the bucket is created."""
+        key = (service, region, account_id)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(max_rate=max_rate)
+            return self._buckets[key]
+
+    def attach(self, client, account_id: str, max_rate: float = MAX_RATE):
+        """Routes every request of the client through the bucket of its key.
+
+        max_rate caps the bucket for the apis with a documented request rate.
+        """
+        if client is None:
+            return client
+
+        service = client.meta.service_model.service_name
+        bucket = self.bucket(service, client.meta.region_name, account_id, max_rate)
+
+        def before_send(**kwargs):
+            bucket.acquire()
+
+        def needs_retry(response=None, **kwargs):
+            if response is not None:
+                code = response[1].get("Error", {}).get("Code")
+                if code in THROTTLING_ERROR_CODES:
+                    bucket.on_throttle()
+
+        def after_call(http_response=None, **kwargs):
+            if http_response is not None and http_response.status_code < 300:
+                bucket.on_success()
+
+        client.meta.events.register("before-send", before_send)
+        client.meta.events.register("needs-retry", needs_retry)
+        client.meta.events.register("after-call", after_call)
+        return client
+
+    def throttle_count(self) -> int:
+        with self._lock:
+            return sum(bucket.throttles for bucket in self._buckets.values())
+
+    def report(self):
+        """Logs the rate every bucket settled at."""
+        with self._lock:
+            items = sorted(self._buckets.items())
+        for (service, region, account_id), bucket in items:
+            if bucket.throttles > 0:
+                logger.info(
+                    f"{service} in {region} for {account_id} settled at {bucket.rate:.2f} calls/s "
+                    f"after {bucket.throttles} throttles"
+                )
+        logger.info(f"the total number of throttled calls: {self.throttle_count()}")
+
+
+rate_limiter = AdaptiveRateLimiter()
+
+
+def attach_rate_limiter(client, account_id: str, max_rate: float = MAX_RATE):
+    """Attaches the shared limiter of the run to the client."""
+    return rate_limiter.attach(client, account_id, max_rate)
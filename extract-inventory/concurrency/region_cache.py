@@ -0,0 +1,70 @@
+# -----------------------------------------------------------------
+# region_cache.py
+#
+# Per account cache of the enabled regions, persisted to a json file with a TTL.
+# The regions are fetched once per account, so the extraction fan-out only
+# targets the regions that can answer instead of failing one by one on the
+# disabled or unsubscribed regions.
+#
+# -----------------------------------------------------------------
+
+import os
+import json
+import logging
+import threading
+
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class RegionCache:
+    """Enabled regions per account, reused until they are older than ttl_seconds."""
+
+    def __init__(self, filename: str, ttl_seconds: float):
+        self.filename = filename
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self._entries = json.load(f)
+            logger.info(f"{len(self._entries)} accounts are loaded from {filename}")
+
+    def _save(self):
+        temp_name = f"{self.filename}.tmp"
+        with open(temp_name, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(temp_name, self.filename)
+
+    def enabled_regions(self, account_id: str, fetch):
+        """Returns the cached regions of the account or stores the ones fetch() returns.
+
+        fetch returns None when the regions cannot be discovered, it is not cached then.
+        """
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if entry and time() - entry["fetched_at"] < self.ttl_seconds:
+                return entry["regions"]
+
+        regions = fetch()
+        if regions is None:
+            return None
+
+        with self._lock:
+            self._entries[account_id] = {"regions": regions, "fetched_at": time()}
+            self._save()
+        return regions
+
+
+def describe_enabled_regions(ec2_client):
+    """Lists the regions enabled for the account of the client."""
+    response = ec2_client.describe_regions(
+        Filters=[
+            {
+                "Name": "opt-in-status",
+                "Values": ["opt-in-not-required", "opted-in"],
+            }
+        ]
+    )
+    return sorted(one["RegionName"] for one in response["Regions"])
@@ -0,0 +1,125 @@
+# -----------------------------------------------------------------
+# report_writer.py
+#
+# Streams the extraction rows to sharded part-files as they arrive instead of
+# keeping every row in memory. When the run finishes every part is sorted on its
+# own and the sorted parts are merged into the final csv report, so the peak
+# memory is bounded by the shard size.
+#
+# -----------------------------------------------------------------
+
+import os
+import re
+import csv
+import json
+import heapq
+import datetime
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SHARD_SIZE = int(os.getenv("REPORT_SHARD_SIZE", 100000))
+# the dates and timestamps of the rows, written with str() or isoformat()
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}([ T]|$)")
+
+
+def typed_sort_key(value):
+    """Orders the numbers by value, then the dates in time order, then the other values as text, the missing ones last."""
+    if value is None or value == "":
+        return (3, 0, "")
+    if isinstance(value, (int, float)):
+        return (0, value, "")
+    if isinstance(value, str) and DATE_PATTERN.match(value):
+        try:
+            timestamp = datetime.datetime.fromisoformat(value)
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+            return (1, timestamp.timestamp(), "")
+        except ValueError:
+            pass
+    return (2, 0, str(value))
+
+
+class ShardedReportWriter:
+    """Writes rows to part-files and merges them into a csv report sorted by sort_key."""
+
+    def __init__(self, report_name: str, sort_key: str, shard_size: int = SHARD_SIZE):
+        self.report_name = report_name
+        self.sort_key = sort_key
+        self.shard_size = shard_size
+        self.rows_written = 0
+        self._parts_dir = f"{report_name}.parts"
+        self._parts = []
+        self._part = None
+        self._part_rows = 0
+        # every column seen in the rows, in the order of appearance
+        self._columns = {}
+        self._lock = threading.Lock()
+        os.makedirs(self._parts_dir, exist_ok=True)
+
+    def _sort_value(self, row):
+        return typed_sort_key(row.get(self.sort_key))
+
+    def _next_part(self):
+        if self._part:
+            self._part.close()
+        name = os.path.join(self._parts_dir, f"part_{len(self._parts):05d}.jsonl")
+        self._parts.append(name)
+        self._part = open(name, "w")
+        self._part_rows = 0
+
+    def write(self, rows):
+        """Appends the rows, a list or a generator, to the part-files and flushes them."""
+        if not rows:
+            return
+
+        with self._lock:
+            for row in rows:
+                if self._part is None or self._part_rows >= self.shard_size:
+                    self._next_part()
+                self._columns.update(dict.fromkeys(row))
+                self._part.write(json.dumps(row, default=str) + "\n")
+                self._part_rows += 1
+                self.rows_written += 1
+            self._part.flush()
+
+    def _sort_part(self, name):
+        with open(name) as f:
+            rows = [json.loads(line) for line in f]
+        rows.sort(key=self._sort_value)
+        with open(name, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+    @staticmethod
+    def _read_part(name):
+        with open(name) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def close(self):
+        """Sorts the parts, merges them into the report and removes the parts."""
+        with self._lock:
+            if self._part:
+                self._part.close()
+                self._part = None
+
+            for name in self._parts:
+                self._sort_part(name)
+
+            with open(self.report_name, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(self._columns), restval="")
+                writer.writeheader()
+                writer.writerows(
+                    heapq.merge(
+                        *[self._read_part(name) for name in self._parts],
+                        key=self._sort_value,
+                    )
+                )
+
+            shutil.rmtree(self._parts_dir)
+            logger.info(
+                f"{self.rows_written} rows from {len(self._parts)} parts are written to {self.report_name}"
+            )
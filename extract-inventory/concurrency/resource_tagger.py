@@ -11,15 +11,25 @@
 # This script takes the resource volume_id or snapshot_id from the file and extracts CloudTrail "Create" event for the resource
 # Extracted event is passed as an execution input to the resource_monitoring state machine to tag the resources
 #
+# The rows are grouped by (account, region) and the groups run in a bounded worker pool with one
+# session per group. A group with many resources reads the CreateVolume / CreateSnapshot events of
+# the lookup window once and matches them locally instead of looking up every resource. The scan
+# reads at most as many pages as the lookups it replaces, the resources it does not find, or all
+# of them when it fails, are looked up one by one.
+#
 # -----------------------------------------------------------------
 
-import boto3
 import logging
 import csv
 import json
+import datetime
 from botocore.exceptions import ClientError, ProfileNotFound
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
 
+from credential_broker import get_profile_session
+from rate_limiter import attach_rate_limiter
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,52 +40,97 @@ accounts = {
     "WU2-A1": "0000000000000",
 }
 
+MAX_WORKERS = 10
+# LookupEvents accepts 2 calls per second per account and region
+LOOKUP_EVENTS_RATE = 2
+# CloudTrail keeps the event history for 90 days
+LOOKUP_DAYS = 90
+# groups with at least these many resources scan the create events instead of a lookup per resource
+SCAN_THRESHOLD = 20
+CREATE_EVENT_NAMES = {
+    "vol": ["CreateVolume"],
+    "snap": ["CreateSnapshot", "CreateSnapshots"],
+}
+
 
-def extract_and_process_resources(csv_filename):
-    """Extracts resources from a CSV file and processes them."""
+def extract_and_process_resources(csv_filename, max_workers=MAX_WORKERS, lookup_days=LOOKUP_DAYS):
+    """Extracts resources from a CSV file and processes them per (account, region)."""
     try:
+        groups = {}
         with open(csv_filename, mode="r", newline="") as file:
             csv_reader = csv.DictReader(file)
             for row in csv_reader:
-                account_id = row["account_id"]
-                region = row["region"]
                 resource_name = row.get("volume_id") or row.get("snapshot_id")
-                process_resource(account_id, region, resource_name)
+                groups.setdefault((row["account_id"], row["region"]), []).append(resource_name)
     except FileNotFoundError:
         logger.error(f"File {csv_filename} not found.")
+        return
     except Exception as e:
         logger.error(f"An error occurred while processing the CSV file: {e}")
+        return
 
+    logger.info(f"{sum(len(one) for one in groups.values())} resources in {len(groups)} account regions")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(process_resources, account_id, region, resource_names, lookup_days): (account_id, region)
+            for (account_id, region), resource_names in groups.items()
+        }
+        for future in as_completed(futures):
+            account_id, region = futures[future]
+            logger.info(f"{future.result()} executions started for {account_id} in {region}")
 
-def process_resource(account_id, region, resource_name):
-    """Processes a single resource by looking up CloudTrail events and executing the state machine."""
+
+def process_resources(account_id, region, resource_names, lookup_days=LOOKUP_DAYS):
+    """Processes the resources of one account and region with a single session, returns the started executions."""
     try:
-        spoke_client = get_session(account_id, region).client("cloudtrail")
-        result = lookup_cloudtrail_events(spoke_client, resource_name)
-        if result:
-            for item in result:
-                cloudtrail_event = json.loads(item["CloudTrailEvent"])
-                cloudtrail_event.pop("sessionCredentialFromConsole", None)
-                formatted_result = format_event(item, cloudtrail_event)
-                execution_input = json.dumps(formatted_result, indent=2)
-                execute_resource_monitoring_state_machine(
-                    account_id, region, execution_input
-                )
-        else:
-            logger.info(f"No events found for resource {resource_name}")
+        session = get_session(account_id, region)
+        # the cloudtrail client only calls LookupEvents, its bucket never exceeds its limit
+        spoke_client = attach_rate_limiter(session.client("cloudtrail"), account_id, LOOKUP_EVENTS_RATE)
+        sf_client = session.client("stepfunctions")
     except ProfileNotFound:
         logger.error(f"Profile for account {account_id} not found.")
+        return 0
     except Exception as e:
-        logger.error(
-            f"An error occurred while processing resource {resource_name}: {e}"
-        )
+        logger.error(f"An error occurred while creating the clients for {account_id} in {region}: {e}")
+        return 0
+
+    events = {}
+    if len(resource_names) >= SCAN_THRESHOLD:
+        events = scan_create_events(spoke_client, resource_names, lookup_days)
+        if events is None:
+            logger.warning(f"the create events of {account_id} in {region} are looked up per resource")
+            events = {}
+
+    executions = 0
+    for resource_name in resource_names:
+        result = events.get(resource_name)
+        if result is None:
+            # not scanned, beyond the scanned pages or older than the scanned window
+            result = lookup_cloudtrail_events(spoke_client, resource_name)
+        try:
+            if result:
+                for item in result:
+                    cloudtrail_event = json.loads(item["CloudTrailEvent"])
+                    cloudtrail_event.pop("sessionCredentialFromConsole", None)
+                    formatted_result = format_event(item, cloudtrail_event)
+                    execution_input = json.dumps(formatted_result, indent=2)
+                    executions += execute_resource_monitoring_state_machine(
+                        account_id, region, execution_input, sf_client
+                    )
+            else:
+                logger.info(f"No events found for resource {resource_name}")
+        except Exception as e:
+            logger.error(
+                f"An error occurred while processing resource {resource_name}: {e}"
+            )
+    return executions
 
 
 def get_session(account_id, region):
     """Generates a boto3 session for the specified account and region."""
     profile = f"{account_id}-role_DEVOPS"
     try:
-        session = boto3.session.Session(profile_name=profile, region_name=region)
+        session = get_profile_session(profile, region)
         logger.info(f"Using profile name: {profile}")
         return session
     except ProfileNotFound:
@@ -105,6 +160,54 @@ def lookup_cloudtrail_events(client, resource_name):
         return []
 
 
+def scan_create_events(client, resource_names, lookup_days=LOOKUP_DAYS, max_pages=None):
+    """Reads the create events of the resource types in the lookup window once and matches them to the resources.
+
+    The scan stops once every resource is found or after max_pages pages, one page per
+    resource by default. Returns None when the scan fails.
+    """
+    wanted = set(resource_names)
+    if max_pages is None:
+        max_pages = len(wanted)
+    pages = 0
+    start_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=lookup_days)
+    event_names = {
+        event_name
+        for resource_name in wanted
+        for event_name in CREATE_EVENT_NAMES.get(resource_name.split("-")[0], [])
+    }
+    events = {}
+    try:
+        paginator = client.get_paginator("lookup_events")
+        for event_name in sorted(event_names):
+            response_iterator = paginator.paginate(
+                LookupAttributes=[
+                    {"AttributeKey": "EventName", "AttributeValue": event_name},
+                ],
+                StartTime=start_time,
+            )
+            for response in response_iterator:
+                pages += 1
+                for event in response["Events"]:
+                    for resource in event.get("Resources", []):
+                        resource_name = resource.get("ResourceName")
+                        # as lookup_cloudtrail_events, a CreateSnapshot event also lists its source volume
+                        if resource_name in wanted and resource_name.split("-")[0] in event["EventName"].lower():
+                            events.setdefault(resource_name, []).append(event)
+                if len(events) == len(wanted):
+                    return events
+                if pages >= max_pages:
+                    logger.info(f"{len(wanted) - len(events)} resources not found in {pages} pages of create events")
+                    return events
+    except ClientError as err:
+        handle_client_error(err)
+        return None
+    except Exception as e:
+        logger.error(f"An error occurred while scanning CloudTrail events: {e}")
+        return None
+    return events
+
+
 def handle_client_error(err):
     """Handles ClientError exceptions."""
     error_code = err.response["Error"]["Code"]
@@ -131,20 +234,21 @@ def format_event(item, cloudtrail_event):
     }
 
 
-def execute_resource_monitoring_state_machine(account_id, region, execution_input):
-    """Executes the state machine with the extracted event as input."""
+def execute_resource_monitoring_state_machine(account_id, region, execution_input, sf_client):
+    """Executes the state machine with the extracted event as input, returns 1 when it was started."""
     try:
         _account_id = accounts[account_id]
-        sf_client = get_session(account_id, region).client("stepfunctions")
         response = sf_client.start_execution(
             stateMachineArn=f"arn:aws:states:{region}:{_account_id}:stateMachine:Resource-Monitoring",
             input=execution_input,
         )
         logger.info(f"State machine execution started: {response}")
+        return 1
     except ClientError as err:
         handle_client_error(err)
     except Exception as e:
         logger.error(f"An error occurred while executing the state machine: {e}")
+    return 0
 
 
 if __name__ == "__main__":
@@ -152,6 +256,8 @@ if __name__ == "__main__":
         description="Process a CSV file containing resource information."
     )
     parser.add_argument("csv_filename", type=str, help="The CSV file to be processed.")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="account regions processed at the same time")
+    parser.add_argument("--days", type=int, default=LOOKUP_DAYS, help="days of create events scanned per account region")
     args = parser.parse_args()
 
-    extract_and_process_resources(args.csv_filename)
+    extract_and_process_resources(args.csv_filename, args.workers, args.days)
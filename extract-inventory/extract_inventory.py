@@ -7,6 +7,9 @@ import botocore
 from pandas import DataFrame, read_csv
 from typing import Final
 import extraction_utils
+from concurrency.credential_broker import get_profile_session
+from concurrency.instrumentation import dump_api_metrics
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from botocore.exceptions import ClientError
 
@@ -53,14 +56,39 @@ SEARCH_REGION = os.getenv(
     "SEARCH_REGION",
     "eu-west-1",
 )  # SEARCH_REGION = os.getenv("SEARCH_REGION", "eu-west-1")
+MULTI_REGION = os.getenv("MULTI_REGION", "NO")  # YES: all the regions in one run and one report
+# the regions of a MULTI_REGION run when SEARCH_REGION is not set
+ALL_REGIONS = [
+    "eu-west-1",
+    "ap-northeast-2",
+    "ap-south-1",
+    "ap-southeast-1",
+    "ap-southeast-2",
+    "eu-central-1",
+    "eu-north-1",
+    "eu-west-2",
+    "eu-west-3",
+    "us-east-1",
+    "us-east-2",
+    "us-west-2",
+]
+MULTI_REGION_NAME = "ALL"
 print
 KEY_TAG_NAME = ""
 SPECIFIC_ACCOUNT = "495416159460"
-EXTRACT_TAGS_RESOURCE_TYPE = os.getenv("EXTRACT_TAGS_RESOURCE_TYPE", "EC2")
+EXTRACT_TAGS_RESOURCE_TYPE = os.getenv("EXTRACT_TAGS_RESOURCE_TYPE", "EC2")  # EC2, VOLUME, TAGGING_API
+# resource types of the TAGGING_API mode
+EXTRACT_TAGS_RESOURCE_TYPE_FILTERS = os.getenv(
+    "EXTRACT_TAGS_RESOURCE_TYPE_FILTERS", "ec2:instance,ec2:volume"
+).split(",")
 RESUME_EXTRACTION = os.getenv("RESUME_EXTRACTION", "NO")
 INSTANCE_TAGGING = os.getenv("INSTANCE_TAGGING", False)
 OS_PLATFORM = os.getenv("OS_PLATFORM", "All")  # Windows, Linux/UNIX, All
 TAGGING_DRY_RUN = os.getenv("TAGGING_DRY_RUN", False)
+# YES: EXTRACT_INSPECTOR reads the spokes from the Inspector delegated administrator
+INSPECTOR_DELEGATED_ADMIN = os.getenv("INSPECTOR_DELEGATED_ADMIN", "NO")
+# the delegated administrator account, the hub account itself when it is empty
+INSPECTOR_ADMIN_ACCOUNT = os.getenv("INSPECTOR_ADMIN_ACCOUNT", "")
 
 logging.basicConfig(
     filename=f"extract-inventory-logfile-{datetime.datetime.now().strftime('%d-%m-%y-%H-%M-%S')}.log",
@@ -75,8 +103,8 @@ logger = logging.getLogger("urbanGUI")
 logger.info(f"max item: {MAX_ITEM}")
 
 
-def get_ddb_table(session: boto3.session.Session):
-    client_ddb = session.client("dynamodb")
+def get_ddb_table(session: boto3.session.Session, region: str = None):
+    client_ddb = session.client("dynamodb", region_name=region)
 
     response_dynamodb = client_ddb.list_tables()
     _table_name = None
@@ -86,13 +114,18 @@ def get_ddb_table(session: boto3.session.Session):
     return _table_name
 
 
-def get_account_ids(_table_name: str, account_type="ALL", region: str = "eu-west-1"):
+def get_account_ids(
+    session: boto3.session.Session,
+    _table_name: str,
+    account_type="ALL",
+    region: str = "eu-west-1",
+):
     if account_type == "Specific":
-        return {SPECIFIC_ACCOUNT: SEARCH_REGION}
+        return {SPECIFIC_ACCOUNT: region}
 
     if _table_name:
-        ddb_resource = dev_session.resource("dynamodb", region_name=region).Table(
-            table_name
+        ddb_resource = session.resource("dynamodb", region_name=region).Table(
+            _table_name
         )
     else:
         logger.error("table name is not provided")
@@ -190,7 +223,9 @@ def extraction(
     _account_id: str = None,
     what_to_extract: int = EXTRACT_LAMBDAS,
     _region: str = "eu-west-1",
+    search_region: str = None,
 ):
+    """Runs the extraction of one account, search_region is the region being extracted, _region when it is not set."""
     if what_to_extract == EXTRACT_LAMBDAS:
         return extraction_utils.extract_functions(
             session, _account_id, _region, EXTRACT_LOGS, EXTRACT_FUNCTION_URLS, MAX_ITEM
@@ -224,7 +259,7 @@ def extraction(
             session, _account_id, _region, INSTANCE_TAGGING, OS_PLATFORM, TAGGING_DRY_RUN
         )
     elif what_to_extract == EXTRACT_IMAGES:
-        return extraction_utils.extract_images(session, _account_id, SEARCH_REGION)
+        return extraction_utils.extract_images(session, _account_id, search_region or _region)
     elif what_to_extract == EXTRACT_TAGS:
         return extraction_utils.extract_tags(
             session,
@@ -233,6 +268,7 @@ def extraction(
             KEY_TAG_NAME,
             MAX_ITEM,
             EXTRACT_TAGS_RESOURCE_TYPE,
+            EXTRACT_TAGS_RESOURCE_TYPE_FILTERS,
         )
     elif what_to_extract == EXTRACT_SES_IDENTITIES:
         return extraction_utils.extract_ses_verified_identities(
@@ -250,130 +286,238 @@ def extraction(
         raise Exception("no proper option was given")
 
 
+def get_hub_session(hub_name: str, region: str):
+    global PROFILE
+    if IS_ENTERPRISE.lower() == "yes":
+        enterprise_profile = f"{hub_name}-role_DEVOPS"
+        return get_profile_session(enterprise_profile, region)
+
+    PROFILE = f"{hub_name}-role_OPERATIONS"
+    try:
+        return get_profile_session(PROFILE, region)
+    except botocore.exceptions.ProfileNotFound:
+        PROFILE = f"{hub_name}-role_OPERATIONS"
+        return get_profile_session(PROFILE, region)
+
+
+def extract_accounts(session: boto3.session.Session, accounts, search_region: str = None):
+    """Extracts the accounts one by one in the search_region.
+
+    Returns the rows, the errors and the accounts left unprocessed when the token expired.
+    """
+    if EXTRACTION_TYPE == EXTRACT_INSPECTOR and INSPECTOR_DELEGATED_ADMIN.lower() == "yes":
+        return extract_inspector_accounts(session, accounts)
+
+    function_reports = []
+    error_reports = []
+    accounts = list(accounts)
+    total_accounts = len(accounts)
+    for index, (account_id, _region) in enumerate(accounts):
+        logger.info(f"account_id:{account_id} is in progress")
+        logger.info(f"account {index + 1} of {total_accounts}")
+        try:
+            tmp_list = extraction(session, account_id, EXTRACTION_TYPE, _region, search_region)
+            if tmp_list is None:
+                error_reports.append((account_id, "assume error"))
+            else:
+                function_reports.extend(tmp_list)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ExpiredToken":
+                logger.warning(f"An exception occurred:{e}")
+                return function_reports, error_reports, accounts[index:]
+        except Exception as e:
+            logger.error(f"An exception occurred:{e}")
+            error_reports.append((account_id, e))
+    return function_reports, error_reports, []
+
+
+def extract_inspector_accounts(session: boto3.session.Session, accounts):
+    """Reads the Inspector status of the accounts in batches from the delegated administrator."""
+    accounts = list(accounts)
+    try:
+        return (
+            extraction_utils.extract_inspector_delegated(
+                session, dict(accounts), INSPECTOR_ADMIN_ACCOUNT or None
+            ),
+            [],
+            [],
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("ExpiredToken", "ExpiredTokenException"):
+            logger.warning(f"An exception occurred:{e}")
+            return [], [], accounts
+        logger.error(f"An exception occurred:{e}")
+        return [], [(account_id, e) for account_id, _ in accounts], []
+
+
+def write_resume_file(accounts):
+    logger.warning(
+        "To resume the extraction, refresh the token and run the script again with RESUME_EXTRACTION=YES"
+    )
+    with open("resume-extraction.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["account_id", "region"])
+        for acccount in accounts:
+            writer.writerow(acccount)
+    logger.info("the unprocessed accounts can be found in resume-extraction.csv")
+
+
+def read_resume_file():
+    try:
+        with open("resume-extraction.csv") as f:
+            reader = csv.reader(f)
+            next(reader)  # skips header
+            return {row[0]: row[1] for row in reader}
+    except FileNotFoundError:
+        logger.error(
+            "resume-extraction.csv file not found, please run the script without RESUME_EXTRACTION=NO"
+        )
+        return None
+
+
+def write_reports(function_reports, error_reports, hub_name: str, region_name: str):
+    if len(function_reports) > 0:
+        function_reports = sorted(
+            function_reports,
+            key=lambda x: x[key_word_to_sort(EXTRACTION_TYPE)],
+            reverse=False,
+        )
+        df = DataFrame(function_reports)
+        df.to_csv(
+            f"{key_word_to_sort(EXTRACTION_TYPE)}_{hub_name}_{'' if ARE_SPOKES_INCLUDED.lower() == 'no' else 'spokes'}_{region_name}_{ACCOUNT_TYPE}_{ENVIRONMENT_TYPE}_{tag_date()}.csv",
+            index=False,
+        )
+    else:
+        logger.warning(
+            f"no data found for the extraction {EXTRACTION_TYPE} for {hub_name} in {region_name}"
+        )
+
+    if len(error_reports) > 0:
+        df_errors = DataFrame(error_reports)
+        df_errors.to_csv(f"errors_{hub_name}_{region_name}.csv", index=False)
+
+
+def extract_region(hub_name: str, one_region: str, session: boto3.session.Session):
+    """Extracts the accounts listed in the metadata table of the region with the hub session."""
+    if ARE_SPOKES_INCLUDED.lower() == "no":
+        try:
+            tmp_list = extraction(session, None, EXTRACTION_TYPE, one_region, one_region)
+            if tmp_list is None:
+                return [], [(hub_name, "assume error")], []
+            return tmp_list, [], []
+        except Exception as e:
+            logger.error(f"An exception occurred:{e}")
+            return [], [(hub_name, e)], []
+
+    logger.info(f"profile name: {PROFILE}")
+    # iterate through the list of failed account ids
+    if PROCESS_FAILED_SPOKES.lower() == "yes":
+        df_failures = read_csv(f"errors_{hub_name}_{one_region}.csv")
+        account_ids = dict.fromkeys(df_failures["0"].to_list(), one_region)
+    else:
+        table_name = get_ddb_table(session, one_region)
+        if table_name is None:
+            logger.warning(
+                f"there is no table for the region {one_region} in the hub {hub_name}"
+            )
+            return [], [], []
+        account_ids = get_account_ids(session, table_name, ACCOUNT_TYPE, one_region)
+        if account_ids is None:
+            logger.warning(
+                f"there are no accounts for the region {one_region} in the hub {hub_name}"
+            )
+            return [], [], []
+    return extract_accounts(session, account_ids.items(), one_region)
+
+
+def extract_regions(hub_name: str, regions):
+    """Extracts the regions of the hub in one process with a single consolidated report.
+
+    The hub session and so the assumed spoke roles are shared by every region, the
+    regions run side by side as the separate processes of iterate-regions.sh did.
+    The session serialises the creation of its clients and resources, the clients
+    themselves are thread safe and each region thread uses its own resources.
+    """
+    hub_session = get_hub_session(hub_name, regions[0])
+
+    if ARE_SPOKES_INCLUDED.lower() == "yes" and (
+        RESUME_EXTRACTION.lower() == "yes" or PROCESS_FAILED_SPOKES.lower() == "yes"
+    ):
+        if RESUME_EXTRACTION.lower() == "yes":
+            account_ids = read_resume_file()
+            if account_ids is None:
+                return
+        else:
+            df_failures = read_csv(f"errors_{hub_name}_{MULTI_REGION_NAME}.csv")
+            account_ids = dict(zip(df_failures["0"].to_list(), df_failures["2"].to_list()))
+        # the accounts are extracted again in their own region
+        units = {}
+        for account_id, _region in account_ids.items():
+            units.setdefault(_region, []).append((account_id, _region))
+        with ThreadPoolExecutor(max_workers=len(units) or 1) as executor:
+            results = dict(
+                zip(units, executor.map(lambda one: extract_accounts(hub_session, units[one], one), units))
+            )
+    else:
+        # the hub account itself is extracted with a session of the region
+        sessions = {
+            region: hub_session if ARE_SPOKES_INCLUDED.lower() == "yes" else get_hub_session(hub_name, region)
+            for region in regions
+        }
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            results = dict(
+                zip(regions, executor.map(lambda one: extract_region(hub_name, one, sessions[one]), regions))
+            )
+
+    function_reports = []
+    error_reports = []
+    unprocessed = []
+    for region, (region_reports, region_errors, region_unprocessed) in results.items():
+        for row in region_reports:
+            row.setdefault("region", region)
+        function_reports.extend(region_reports)
+        error_reports.extend([(*error, region) for error in region_errors])
+        unprocessed.extend(region_unprocessed)
+
+    if unprocessed:
+        write_resume_file(unprocessed)
+    write_reports(function_reports, error_reports, hub_name, MULTI_REGION_NAME)
+    logger.info(
+        f"extraction type is {EXTRACTION_TYPE} for {hub_name} completed.. in the regions {','.join(regions)}"
+    )
+
+
 hub_names = HUB_NAMES.split(",")
 regions = SEARCH_REGION.split(",")
+if MULTI_REGION.lower() == "yes" and os.getenv("SEARCH_REGION") is None:
+    regions = ALL_REGIONS
 
 for hub_name in hub_names:
-    for one_region in regions:
-        error_reports = []
-        function_reports = []
+    if MULTI_REGION.lower() == "yes":
+        extract_regions(hub_name, regions)
+        continue
 
-        if IS_ENTERPRISE.lower() == "yes":
-            enterprise_profile = f"{hub_name}-role_DEVOPS"
-            dev_session = boto3.session.Session(
-                profile_name=enterprise_profile, region_name=one_region
-            )
-        else:
-            PROFILE = f"{hub_name}-role_OPERATIONS"
-            try:
-                dev_session = boto3.session.Session(
-                    profile_name=PROFILE, region_name=one_region
-                )
-            except botocore.exceptions.ProfileNotFound:
-                PROFILE = f"{hub_name}-role_OPERATIONS"
-                dev_session = boto3.session.Session(
-                    profile_name=PROFILE, region_name=one_region
-                )
-
-        if ARE_SPOKES_INCLUDED.lower() == "yes":
+    for one_region in regions:
+        dev_session = get_hub_session(hub_name, one_region)
+        if ARE_SPOKES_INCLUDED.lower() == "yes" and RESUME_EXTRACTION.lower() == "yes":
             logger.info(f"profile name: {PROFILE}")
-
-            if RESUME_EXTRACTION.lower() == "yes":
-                try:
-                    with open("resume-extraction.csv") as f:
-                        reader = csv.reader(f)
-                        next(reader)  # skips header
-                        account_ids = {row[0]: row[1] for row in reader}
-                except FileNotFoundError:
-                    logger.error(
-                        "resume-extraction.csv file not found, please run the script without RESUME_EXTRACTION=NO"
-                    )
-                    break
-            # iterate through the list of failed account ids
-            elif PROCESS_FAILED_SPOKES.lower() == "yes":
-                df_failures = read_csv(f"errors_{hub_name}_{one_region}.csv")
-                account_ids = df_failures["0"].to_list()
-            else:
-                table_name = get_ddb_table(dev_session)
-                if table_name is None:
-                    logger.warning(
-                        f"there is no table for the region {one_region} in the hub {hub_name}"
-                    )
-                    continue
-                account_ids = get_account_ids(table_name, ACCOUNT_TYPE, one_region)
-                if account_ids is None:
-                    logger.warning(
-                        f"there are no accounts for the region {one_region} in the hub {hub_name}"
-                    )
-                    continue
-            accounts = account_ids.items()
-            total_accounts = len(accounts)
-            i = 1
-            index = 0
-            for account_id, _region in accounts:
-                logger.info(f"account_id:{account_id} is in progress")
-                logger.info(f"account {i} of {total_accounts}")
-                i += 1
-                try:
-                    tmp_list = extraction(
-                        dev_session, account_id, EXTRACTION_TYPE, _region
-                    )
-                    if tmp_list is None:
-                        error_reports.append((account_id, "assume error"))
-                    else:
-                        function_reports.extend(tmp_list)
-                    index += 1
-                except ClientError as e:
-                    if e.response["Error"]["Code"] == "ExpiredToken":
-                        logger.warning(f"An exception occurred:{e}")
-                        logger.warning(
-                            "To resume the extraction, refresh the token and run the script again with RESUME_EXTRACTION=YES"
-                        )
-                        with open("resume-extraction.csv", "w", newline="") as f:
-                            writer = csv.writer(f)
-                            writer.writerow(["account_id", "region"])
-                            accounts = list(accounts)[index:]
-                            for acccount in accounts:
-                                writer.writerow(acccount)
-                        logger.info(
-                            "the unprocessed accounts can be found in resume-extraction.csv"
-                        )
-                        break
-                except Exception as e:
-                    logger.error(f"An exception occurred:{e}")
-                    error_reports.append((account_id, e))
-        elif ARE_SPOKES_INCLUDED.lower() == "no":
-            try:
-                tmp_list = extraction(dev_session, None, EXTRACTION_TYPE)
-                if tmp_list is None:
-                    error_reports.append((hub_name, "assume error"))
-                else:
-                    function_reports.extend(tmp_list)
-
-            except Exception as e:
-                logger.error(f"An exception occurred:{e}")
-                error_reports.append((hub_name, e))
-
-        if len(function_reports) > 0:
-            function_reports = sorted(
-                function_reports,
-                key=lambda x: x[key_word_to_sort(EXTRACTION_TYPE)],
-                reverse=False,
-            )
-            df = DataFrame(function_reports)
-            df.to_csv(
-                f"{key_word_to_sort(EXTRACTION_TYPE)}_{hub_name}_{'' if ARE_SPOKES_INCLUDED.lower() == 'no' else 'spokes'}_{one_region}_{ACCOUNT_TYPE}_{ENVIRONMENT_TYPE}_{tag_date()}.csv",
-                index=False,
+            account_ids = read_resume_file()
+            if account_ids is None:
+                break
+            function_reports, error_reports, unprocessed = extract_accounts(
+                dev_session, account_ids.items(), one_region
             )
         else:
-            logger.warning(
-                f"no data found for the extraction {EXTRACTION_TYPE} for the account id {account_id if IS_ENTERPRISE == 'NO' else hub_name} in {one_region}"
+            function_reports, error_reports, unprocessed = extract_region(
+                hub_name, one_region, dev_session
             )
 
-        if len(error_reports) > 0:
-            df_errors = DataFrame(error_reports)
-            df_errors.to_csv(f"errors_{hub_name}_{SEARCH_REGION}.csv", index=False)
+        write_reports(function_reports, error_reports, hub_name, one_region)
+        if unprocessed:
+            write_resume_file(unprocessed)
 
         logger.info(
             f"extraction type is {EXTRACTION_TYPE} for {hub_name} completed.. in the region {one_region}"
         )
+
+dump_api_metrics()
@@ -1,9 +1,19 @@
 from botocore.exceptions import ClientError
+import os
+import json
+import atexit
 import boto3
 import logging
 import datetime
 from botocore.exceptions import WaiterError
 import csv
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import monotonic, sleep
+from concurrency.credential_broker import get_broker, split_role_arn
+from concurrency.instrumentation import instrument
+from concurrency.rate_limiter import attach_rate_limiter
 
 logging.basicConfig(
     filename=f"extract-inventory-logfile-{datetime.datetime.now().strftime('%d-%m-%y-%H-%M-%S')}.log",
@@ -17,13 +27,30 @@ logger = logging.getLogger("urbanGUI")
 
 
 LONG_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
-
-
-def create_creds(role: str, session: boto3.session.Session):
-    sts_client = session.client("sts")
-    return sts_client.assume_role(
-        RoleArn=role, RoleSessionName="LambdaInventorySession"
-    )
+# domain join probe per SSM document, the document is picked by the OS family
+SSM_PROBE_COMMANDS = {
+    "AWS-RunShellScript": ["id bp1\\\\serv-W-join-dev -u", "hostname"],
+    "AWS-RunPowerShellScript": ["nltest /sc_query:bp1.ad.bp.com", "hostname"],
+}
+# send_command accepts up to 50 instance ids
+SSM_BATCH_SIZE = 50
+# same timing as the command_executed waiter
+SSM_POLL_DELAY = 5
+SSM_POLL_ATTEMPTS = 20
+SSM_MAX_POLLERS = 10
+SSM_FINAL_STATUSES = ["Success", "Cancelled", "TimedOut", "Failed"]
+AMI_NAME_CACHE_SIZE = 10000
+LOG_ENRICHMENT_WORKERS = int(os.getenv("LOG_ENRICHMENT_WORKERS", 8))
+LOG_EVENTS_CACHE_FILE = os.getenv("LOG_EVENTS_CACHE_FILE", "log_events_cache.json")
+# the changed cache is written at most every these many seconds and at the end of the run
+LOG_EVENTS_CACHE_FLUSH_SECONDS = 300
+NO_LOG_EVENTS = "No log events found in the log group"
+DESCRIBE_IMAGES_BATCH_SIZE = 200
+# the maximum of accountIds of inspector2.batch_get_account_status
+INSPECTOR_BATCH_SIZE = 10
+INSPECTOR_WORKERS = int(os.getenv("INSPECTOR_WORKERS", 8))
+# the errors of a batch reported as the inspector status of its accounts
+INSPECTOR_REPORTED_ERRORS = ["AccessDenied", "AccessDeniedException", "ValidationException"]
 
 
 def create_client(
@@ -31,13 +58,12 @@ def create_client(
 ):
     """Creates a BOTO3 client using the correct target accounts Role."""
     try:
-        creds = create_creds(role, hub_session)
-        client = boto3.client(
-            service,
-            aws_access_key_id=creds["Credentials"]["AccessKeyId"],
-            aws_secret_access_key=creds["Credentials"]["SecretAccessKey"],
-            aws_session_token=creds["Credentials"]["SessionToken"],
-            region_name=region,
+        account_id, role_name = split_role_arn(role)
+        client = instrument(
+            attach_rate_limiter(
+                get_broker(hub_session).client(service, account_id, region, role_name),
+                account_id,
+            )
         )
     except Exception as e:
         logger.error(f"cannot assume the role: {e}")
@@ -261,6 +287,16 @@ def extract_kms(
             ec2_boto_client = session.client("ec2")
             key_client = session.client("kms")
 
+        # key id -> alias names of the account and region, fetched once
+        key_aliases = {}
+        alias_paginator = key_client.get_paginator("list_aliases")
+        for response in alias_paginator.paginate(PaginationConfig={"PageSize": max_item}):
+            for one_alias in response["Aliases"]:
+                if "TargetKeyId" in one_alias:
+                    key_aliases.setdefault(one_alias["TargetKeyId"], []).append(
+                        one_alias["AliasName"]
+                    )
+
         volume_paginator = ec2_boto_client.get_paginator("describe_volumes")
         volume_iterator = volume_paginator.paginate(
             PaginationConfig={"PageSize": max_item}
@@ -269,23 +305,7 @@ def extract_kms(
         volumes = []
         for response in volume_iterator:
             for one in response["Volumes"]:
-                try:
-                    volume = session.resource("ec2").Volume(one["VolumeId"])
-                    if volume.kms_key_id:
-                        response = key_client.list_aliases(
-                            KeyId=volume.kms_key_id[volume.kms_key_id.find("/") + 1:]
-                        )
-                    else:
-                        response["Aliases"] = []
-
-                except ClientError as err:
-                    if err.response["Error"]["Code"] == "InvalidVolume.NotFound":
-                        logger.warning(
-                            f"cannot found {one['VolumeId']} because of {err.response['Error']['Message']}"
-                        )
-                    else:
-                        raise err
-
+                kms_key_id = one.get("KmsKeyId", "")
                 volumes.append(
                     {
                         "instance": (
@@ -293,13 +313,10 @@ def extract_kms(
                             if len(one["Attachments"]) > 0
                             else "not attached"
                         ),
-                        "volume": volume.volume_id,
-                        "state": volume.state,
+                        "volume": one["VolumeId"],
+                        "state": one["State"],
                         "aliases": ",".join(
-                            [
-                                one_alias["AliasName"]
-                                for one_alias in response["Aliases"]
-                            ]
+                            key_aliases.get(kms_key_id[kms_key_id.find("/") + 1:], [])
                         ),
                     }
                 )
@@ -383,25 +400,106 @@ def get_last_log_event(logs_client, log_group_name):
             limit=1,
         )
         if "logStreams" in response and response["logStreams"]:
-            log_stream_name = response["logStreams"][0]["logStreamName"]
-            log_events_response = logs_client.get_log_events(
-                logGroupName=log_group_name,
-                logStreamName=log_stream_name,
-                limit=1,
-                startFromHead=True,
-            )
-            if "events" in log_events_response and log_events_response["events"]:
-                last_log_timestamp = (
-                    log_events_response["events"][0]["timestamp"] / 1000
-                )
-                last_log_time = datetime.fromtimestamp(last_log_timestamp)
-                return last_log_time
+            last_event_timestamp = response["logStreams"][0].get("lastEventTimestamp")
+            if last_event_timestamp:
+                return datetime.datetime.fromtimestamp(last_event_timestamp / 1000)
 
-        return "No log events found in the log group"
+        return NO_LOG_EVENTS
     except Exception as e:
         return str(e)
 
 
+class LastEventCache:
+    """Last event of the log groups per account and region, reused while the stored bytes of the group do not change.
+
+    The file is read on first use and the last events are stored as ISO strings.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entries = None
+        self._changed = False
+        self._last_save = monotonic()
+
+    def _load(self):
+        # called with the lock held
+        if self._entries is None:
+            self._entries = {}
+            if os.path.exists(self.filename):
+                with open(self.filename) as f:
+                    self._entries = json.load(f)
+                logger.info(f"{len(self._entries)} log groups are loaded from {self.filename}")
+        return self._entries
+
+    def get(self, key: str, stored_bytes: int):
+        """Returns the datetime of the last event or NO_LOG_EVENTS, None when it is not cached."""
+        with self._lock:
+            entry = self._load().get(key)
+        if not entry or entry["stored_bytes"] != stored_bytes:
+            return None
+        if entry["last_event"] == NO_LOG_EVENTS:
+            return NO_LOG_EVENTS
+        return datetime.datetime.fromisoformat(entry["last_event"])
+
+    def put(self, key: str, stored_bytes: int, last_event):
+        if isinstance(last_event, datetime.datetime):
+            last_event = last_event.isoformat()
+        with self._lock:
+            self._load()[key] = {"stored_bytes": stored_bytes, "last_event": last_event}
+            self._changed = True
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            temp_name = f"{self.filename}.tmp"
+            with open(temp_name, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(temp_name, self.filename)
+            self._changed = False
+            self._last_save = monotonic()
+
+    def flush(self):
+        """Saves the changes when the last save is older than LOG_EVENTS_CACHE_FLUSH_SECONDS."""
+        if monotonic() - self._last_save >= LOG_EVENTS_CACHE_FLUSH_SECONDS:
+            self.save()
+
+
+log_event_cache = LastEventCache(LOG_EVENTS_CACHE_FILE)
+atexit.register(log_event_cache.save)
+
+
+def get_last_log_events(logs_client, _account_id, _region, log_groups):
+    """Returns the last event of every log group, the groups unchanged since the previous run are not described again."""
+    last_events = {}
+    pending = []
+    for one in log_groups:
+        key = f"{_account_id}:{_region}:{one['logGroupName']}"
+        last_event = log_event_cache.get(key, one["storedBytes"])
+        if last_event is None:
+            pending.append((key, one))
+        else:
+            last_events[one["logGroupName"]] = last_event
+
+    with ThreadPoolExecutor(max_workers=LOG_ENRICHMENT_WORKERS) as executor:
+        futures = {
+            executor.submit(get_last_log_event, logs_client, one["logGroupName"]): (key, one)
+            for key, one in pending
+        }
+        for future in as_completed(futures):
+            key, one = futures[future]
+            last_event = future.result()
+            last_events[one["logGroupName"]] = last_event
+            # the errors are retried by the next run
+            if isinstance(last_event, datetime.datetime) or last_event == NO_LOG_EVENTS:
+                log_event_cache.put(key, one["storedBytes"], last_event)
+
+    if pending:
+        log_event_cache.flush()
+    return last_events
+
+
 def extract_log_groups(
     session: boto3.session.Session,
     _account_id: str = None,
@@ -421,37 +519,42 @@ def extract_log_groups(
             # logGroupNamePattern="DsServices_CWLogs_Host_Linux",
             PaginationConfig={"PageSize": max_item},
         )
+        log_groups = [
+            one for response in response_iterator for one in response["logGroups"]
+        ]
+        # the last events are fetched as a separate, concurrent stage
+        last_events = get_last_log_events(logs_client, _account_id, _region, log_groups)
+
         lg = []
-        for response in response_iterator:
-            for one in response["logGroups"]:
-                seconds_since_epoch = one["creationTime"] / 1000.0
-                timestamp = datetime.utcfromtimestamp(seconds_since_epoch)
-                total_size_kb_bytes = one["storedBytes"] / 1000.0
-                last_log_time = get_last_log_event(logs_client, one["logGroupName"])
-                if last_log_time:
-                    last_event_date = last_log_time
-                else:
-                    last_event_date = "no events"
-                if "retentionInDays" in one:
-                    lg.append(
-                        {
-                            "log_group_name": one["logGroupName"],
-                            "creation": timestamp,
-                            "retentionDays": one["retentionInDays"],
-                            "Size in KB": total_size_kb_bytes,
-                            "last_stream_date": last_event_date,
-                        }
-                    )
-                else:
-                    lg.append(
-                        {
-                            "log_group_name": one["logGroupName"],
-                            "creation": timestamp,
-                            "retentionDays": "No Retention Setup",
-                            "Size in KB": total_size_kb_bytes,
-                            "last_stream_date": last_event_date,
-                        }
-                    )
+        for one in log_groups:
+            seconds_since_epoch = one["creationTime"] / 1000.0
+            timestamp = datetime.datetime.utcfromtimestamp(seconds_since_epoch)
+            total_size_kb_bytes = one["storedBytes"] / 1000.0
+            last_log_time = last_events[one["logGroupName"]]
+            if last_log_time:
+                last_event_date = last_log_time
+            else:
+                last_event_date = "no events"
+            if "retentionInDays" in one:
+                lg.append(
+                    {
+                        "log_group_name": one["logGroupName"],
+                        "creation": timestamp,
+                        "retentionDays": one["retentionInDays"],
+                        "Size in KB": total_size_kb_bytes,
+                        "last_stream_date": last_event_date,
+                    }
+                )
+            else:
+                lg.append(
+                    {
+                        "log_group_name": one["logGroupName"],
+                        "creation": timestamp,
+                        "retentionDays": "No Retention Setup",
+                        "Size in KB": total_size_kb_bytes,
+                        "last_stream_date": last_event_date,
+                    }
+                )
         return lg
     except ClientError as err:
         if err.response["Error"]["Code"] == "AccessDenied":
@@ -633,15 +736,63 @@ def extract_provisioned_products(
             raise err
 
 
-def get_ami_name(ec2_client, ami_id):
-    try:
-        response = ec2_client.describe_images(ImageIds=[ami_id])
-        if "Images" in response and len(response["Images"]) > 0:
-            return response["Images"][0]["Name"]
-        return "Unknown"
-    except Exception as e:
-        print(f"An error occurred while describe image {ami_id}: {e}")
-        return None
+class AmiNameCache:
+    """LRU of the AMI names per (region, image id), shared by every account of the run."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, region: str, ami_id: str):
+        with self._lock:
+            name = self._names.get((region, ami_id))
+            if name is not None:
+                self._names.move_to_end((region, ami_id))
+            return name
+
+    def put(self, region: str, ami_id: str, name: str):
+        with self._lock:
+            self._names[(region, ami_id)] = name
+            self._names.move_to_end((region, ami_id))
+            if len(self._names) > self.maxsize:
+                self._names.popitem(last=False)
+
+
+# the images not visible from an account are not cached, another account may see them
+ami_name_cache = AmiNameCache(AMI_NAME_CACHE_SIZE)
+
+
+def get_ami_names(ec2_client, ami_ids):
+    """Resolves the names of the distinct images with batched describe_images calls, the cached names are reused."""
+    region = ec2_client.meta.region_name
+    names = {}
+    missing = []
+    for ami_id in dict.fromkeys(ami_ids):
+        name = ami_name_cache.get(region, ami_id)
+        if name is None:
+            missing.append(ami_id)
+        else:
+            names[ami_id] = name
+
+    for start in range(0, len(missing), DESCRIBE_IMAGES_BATCH_SIZE):
+        batch = missing[start:start + DESCRIBE_IMAGES_BATCH_SIZE]
+        try:
+            # unlike ImageIds, the image-id filter skips the deleted or unknown images instead of failing the call
+            response = ec2_client.describe_images(
+                Filters=[{"Name": "image-id", "Values": batch}]
+            )
+        except ClientError as e:
+            logger.error(f"An error occurred while describe images {batch}: {e}")
+            for ami_id in batch:
+                names[ami_id] = None
+            continue
+        for image in response["Images"]:
+            names[image["ImageId"]] = image["Name"]
+            ami_name_cache.put(region, image["ImageId"], image["Name"])
+        for ami_id in batch:
+            names.setdefault(ami_id, "Unknown")
+    return names
 
 
 def get_instances(ec2_client, ssm_client, instance_tagging, os_platform):
@@ -649,70 +800,83 @@ def get_instances(ec2_client, ssm_client, instance_tagging, os_platform):
     try:
         paginator = ec2_client.get_paginator("describe_instances")
         response_iterator = paginator.paginate()
-        for response in response_iterator:
-            for reservation in response["Reservations"]:
-                for instance in reservation["Instances"]:
-                    instance_ami_id = instance["ImageId"]
-                    instance_id = instance["InstanceId"]
-                    domain_status = "NA"
-                    cip_status = "N/A"
-                    join_ad = "N/A"
-                    host_name = "N/A"
-                    bp_unique_name = "N/A"
-                    if (
-                        instance["State"]["Name"] == "running"
-                        and instance_tagging is False
-                    ):
-                        # Run SSM command
-                        ssm_output = run_ssm_command(ssm_client, instance_id, instance.get("PlatformDetails", "Unknown"))
-                        if "567862016" in ssm_output or "NERR_Success" in ssm_output:
-                            domain_status = "domain_joined"
+        all_instances = [
+            instance
+            for response in response_iterator
+            for reservation in response["Reservations"]
+            for instance in reservation["Instances"]
+        ]
+        ami_names = get_ami_names(
+            ec2_client, [instance["ImageId"] for instance in all_instances]
+        )
+        ssm_outputs = {}
+        if instance_tagging is False:
+            # Run SSM command on all the running instances at once
+            ssm_outputs = run_ssm_commands(
+                ssm_client,
+                {
+                    instance["InstanceId"]: instance.get("PlatformDetails", "Unknown")
+                    for instance in all_instances
+                    if instance["State"]["Name"] == "running"
+                },
+            )
+        for instance in all_instances:
+            instance_ami_id = instance["ImageId"]
+            instance_id = instance["InstanceId"]
+            domain_status = "NA"
+            cip_status = "N/A"
+            join_ad = "N/A"
+            host_name = "N/A"
+            bp_unique_name = "N/A"
+            if (
+                instance["State"]["Name"] == "running"
+                and instance_tagging is False
+            ):
+                ssm_output = ssm_outputs[instance_id]
+                if "567862016" in ssm_output or "NERR_Success" in ssm_output:
+                    domain_status = "domain_joined"
 
-                        else:
-                            domain_status = "not_domain_joined"
-                        host_name = ssm_output.split("\n")[-1]
-                        # Get the values of cip-status and JoinAD tags
-                        for tag in instance.get("Tags", []):
-                            if tag["Key"] == "cip-status":
-                                cip_status = tag["Value"]
-                            elif tag["Key"] == "JoinAD":
-                                join_ad = tag["Value"]
-                            if tag["Key"] == "bp-unique-name":
-                                bp_unique_name = tag["Value"]
-                    # Tagging specific instances based on platform and instance tagging flag
-                    if instance_tagging is True:
-                        if instance.get("PlatformDetails", "") == os_platform:
-                            instances.append(
-                                {
-                                    "instance_id": instance["InstanceId"],
-                                    "instance_state": instance["State"]["Name"],
-                                    "instance_ami_name": get_ami_name(
-                                        ec2_client, instance_ami_id
-                                    ),
-                                    "image_id": instance_ami_id,
-                                    "cip_status": cip_status,
-                                    "join_ad": join_ad,
-                                    "os": instance.get("PlatformDetails", "Unknown"),
-                                    "domain_status": domain_status,
-                                }
-                            )
-                    else:
-                        instances.append(
-                            {
-                                "instance_id": instance["InstanceId"],
-                                "instance_state": instance["State"]["Name"],
-                                "instance_ami_name": get_ami_name(
-                                    ec2_client, instance_ami_id
-                                ),
-                                "image_id": instance_ami_id,
-                                "cip_status": cip_status,
-                                "join_ad": join_ad,
-                                "os": instance.get("PlatformDetails", "Unknown"),
-                                "domain_status": domain_status,
-                                "host_name": host_name,
-                                "bp-unique-name": bp_unique_name
-                            }
-                        )
+                else:
+                    domain_status = "not_domain_joined"
+                host_name = ssm_output.split("\n")[-1]
+                # Get the values of cip-status and JoinAD tags
+                for tag in instance.get("Tags", []):
+                    if tag["Key"] == "cip-status":
+                        cip_status = tag["Value"]
+                    elif tag["Key"] == "JoinAD":
+                        join_ad = tag["Value"]
+                    if tag["Key"] == "bp-unique-name":
+                        bp_unique_name = tag["Value"]
+            # Tagging specific instances based on platform and instance tagging flag
+            if instance_tagging is True:
+                if instance.get("PlatformDetails", "") == os_platform:
+                    instances.append(
+                        {
+                            "instance_id": instance["InstanceId"],
+                            "instance_state": instance["State"]["Name"],
+                            "instance_ami_name": ami_names[instance_ami_id],
+                            "image_id": instance_ami_id,
+                            "cip_status": cip_status,
+                            "join_ad": join_ad,
+                            "os": instance.get("PlatformDetails", "Unknown"),
+                            "domain_status": domain_status,
+                        }
+                    )
+            else:
+                instances.append(
+                    {
+                        "instance_id": instance["InstanceId"],
+                        "instance_state": instance["State"]["Name"],
+                        "instance_ami_name": ami_names[instance_ami_id],
+                        "image_id": instance_ami_id,
+                        "cip_status": cip_status,
+                        "join_ad": join_ad,
+                        "os": instance.get("PlatformDetails", "Unknown"),
+                        "domain_status": domain_status,
+                        "host_name": host_name,
+                        "bp-unique-name": bp_unique_name
+                    }
+                )
 
         return instances
     except Exception as e:
@@ -720,23 +884,25 @@ def get_instances(ec2_client, ssm_client, instance_tagging, os_platform):
         return None
 
 
+def get_ssm_probe_document(instance_os):
+    if "Linux" in instance_os:
+        return "AWS-RunShellScript"
+    if instance_os == "Windows":
+        return "AWS-RunPowerShellScript"
+    return None
+
+
 def run_ssm_command(ssm_client, instance_id, instance_os):
     ssm_output = "NA"
     try:
-        if ("Linux" in instance_os):
-            response = ssm_client.send_command(
-                InstanceIds=[instance_id],
-                DocumentName="AWS-RunShellScript",
-                Parameters={"commands": ["id bp1\\\\serv-W-join-dev -u", "hostname"]},
-            )
-        elif (instance_os == "Windows"):
-            response = ssm_client.send_command(
-                InstanceIds=[instance_id],
-                DocumentName="AWS-RunPowerShellScript",
-                Parameters={"commands": ["nltest /sc_query:bp1.ad.bp.com", "hostname"]},
-            )
-        else:
+        document = get_ssm_probe_document(instance_os)
+        if document is None:
             raise Exception("Unsupported OS platform")
+        response = ssm_client.send_command(
+            InstanceIds=[instance_id],
+            DocumentName=document,
+            Parameters={"commands": SSM_PROBE_COMMANDS[document]},
+        )
 
         command_id = response["Command"]["CommandId"]
         # Wait for the command to complete
@@ -775,6 +941,107 @@ def run_ssm_command(ssm_client, instance_id, instance_os):
         return ssm_output
 
 
+def get_ssm_ping_statuses(ssm_client):
+    """Returns the ping status of every instance registered in SSM."""
+    paginator = ssm_client.get_paginator("describe_instance_information")
+    return {
+        instance["InstanceId"]: instance["PingStatus"]
+        for page in paginator.paginate()
+        for instance in page["InstanceInformationList"]
+    }
+
+
+def poll_ssm_command(ssm_client, command_id, instance_ids):
+    """Polls the invocations of the command until every instance has finished, like the command_executed waiter."""
+    outputs = {}
+    paginator = ssm_client.get_paginator("list_command_invocations")
+    for _ in range(SSM_POLL_ATTEMPTS):
+        sleep(SSM_POLL_DELAY)
+        for page in paginator.paginate(CommandId=command_id, Details=True):
+            for invocation in page["CommandInvocations"]:
+                instance_id = invocation["InstanceId"]
+                if instance_id in outputs or invocation["Status"] not in SSM_FINAL_STATUSES:
+                    continue
+                # the plugin output is the standard output followed by the standard error
+                output = "".join(
+                    plugin.get("Output", "") for plugin in invocation.get("CommandPlugins", [])
+                ).split("----------ERROR-------")[0].strip()
+                if invocation["Status"] == "Success":
+                    logger.info(f"SSM output for instance {instance_id}: {output}")
+                    outputs[instance_id] = output or "NA"
+                else:
+                    logger.info(
+                        f"SSM command execution failed for instance {instance_id}: {invocation['Status']}"
+                    )
+                    outputs[instance_id] = "ssm-timeout\nNA"
+        if len(outputs) == len(instance_ids):
+            return outputs
+
+    for instance_id in instance_ids:
+        if instance_id not in outputs:
+            logger.info(f"SSM command execution timed out for instance {instance_id}")
+            outputs[instance_id] = "ssm-timeout\nNA"
+    return outputs
+
+
+def run_ssm_commands(ssm_client, instances):
+    """Runs the domain join probe with one SSM command per OS family and batch of instances.
+
+    instances maps the instance ids to their platform, the output of every instance
+    is returned in the format of run_ssm_command.
+    """
+    outputs = {}
+    if not instances:
+        return outputs
+
+    try:
+        ping_statuses = get_ssm_ping_statuses(ssm_client)
+    except Exception as e:
+        logger.info(f"cannot list the SSM managed instances, probing them one by one: {e}")
+        return {
+            instance_id: run_ssm_command(ssm_client, instance_id, instance_os)
+            for instance_id, instance_os in instances.items()
+        }
+
+    batches = {}
+    for instance_id, instance_os in instances.items():
+        document = get_ssm_probe_document(instance_os)
+        if document is None or instance_id not in ping_statuses:
+            outputs[instance_id] = "ssm-notfound\nNA"
+        elif ping_statuses[instance_id] != "Online":
+            # the command would not be delivered before the waiter gives up
+            outputs[instance_id] = "ssm-timeout\nNA"
+        else:
+            batches.setdefault(document, []).append(instance_id)
+
+    commands = []
+    for document, instance_ids in batches.items():
+        for start in range(0, len(instance_ids), SSM_BATCH_SIZE):
+            batch = instance_ids[start:start + SSM_BATCH_SIZE]
+            try:
+                response = ssm_client.send_command(
+                    InstanceIds=batch,
+                    DocumentName=document,
+                    Parameters={"commands": SSM_PROBE_COMMANDS[document]},
+                )
+                commands.append((response["Command"]["CommandId"], batch))
+            except ClientError as e:
+                # one instance not ready for SSM fails the whole batch
+                logger.info(f"SSM command cannot be sent to {len(batch)} instances, probing them one by one: {e}")
+                for instance_id in batch:
+                    outputs[instance_id] = run_ssm_command(ssm_client, instance_id, instances[instance_id])
+
+    if commands:
+        with ThreadPoolExecutor(max_workers=min(len(commands), SSM_MAX_POLLERS)) as executor:
+            futures = [
+                executor.submit(poll_ssm_command, ssm_client, command_id, batch)
+                for command_id, batch in commands
+            ]
+            for future in as_completed(futures):
+                outputs.update(future.result())
+    return outputs
+
+
 def extract_domain_instances(
     session: boto3.session.Session,
     _account_id: str = None,
@@ -1255,7 +1522,7 @@ def tags_per_volume(account_id, ec2_client, item_per_page, key_tag):
     for response in volume_iterator:
         for one in response["Volumes"]:
             _tags = []
-            for tag in one["Tags"]:
+            for tag in one.get("Tags", []):
                 if key_tag in tag["Key"]:
                     _tags.append(tag["Key"])
 
@@ -1286,7 +1553,7 @@ def tags_per_ec2(account_id, ec2_client, item_per_page, key_tag):
         for one in response["Reservations"]:
             for instance in one["Instances"]:
                 _tags = []
-                for tag in instance["Tags"]:
+                for tag in instance.get("Tags", []):
                     if key_tag in tag["Key"]:
                         _tags.append(f"{tag['Key']}={tag['Value']}")
 
@@ -1302,6 +1569,49 @@ def tags_per_ec2(account_id, ec2_client, item_per_page, key_tag):
     return instances
 
 
+def resource_type_of(resource_arn: str) -> str:
+    """Returns the service:type of the arn in the ResourceTypeFilters format, the service alone when the arn has no type."""
+    # arn:aws:ec2:<region>:<account>:instance/i-0123, arn:aws:logs:<region>:<account>:log-group:name or arn:aws:s3:::bucket
+    parts = resource_arn.split(":", 6)
+    service = parts[2]
+    if len(parts) == 7:
+        return f"{service}:{parts[5]}"
+    if "/" in parts[5]:
+        return f"{service}:{parts[5].split('/')[0]}"
+    return service
+
+
+def tags_per_resource(account_id, tagging_client, item_per_page, key_tag, resource_type_filters):
+    """Lists the tagged resources of the types with the Resource Groups Tagging API, one call covers every type.
+
+    As for the other modes, the tags are the ones whose key contains key_tag.
+    """
+    paginator = tagging_client.get_paginator("get_resources")
+    response_iterator = paginator.paginate(
+        ResourceTypeFilters=resource_type_filters,
+        ResourcesPerPage=item_per_page,
+    )
+
+    resources = []
+    for response in response_iterator:
+        for one in response["ResourceTagMappingList"]:
+            resource_arn = one["ResourceARN"]
+            resources.append(
+                {
+                    "account_id": account_id,
+                    "resource_type": resource_type_of(resource_arn),
+                    "resource": resource_arn,
+                    "tags": [
+                        f"{tag['Key']}={tag['Value']}"
+                        for tag in one.get("Tags", [])
+                        if key_tag in tag["Key"]
+                    ],
+                }
+            )
+
+    return resources
+
+
 def extract_tags(
     _session: boto3.session.Session,
     _account_id: str = None,
@@ -1309,18 +1619,28 @@ def extract_tags(
     key_tag: str = None,
     item_per_page: int = 50,
     resource_type: str = "EC2",
+    resource_type_filters: list = None,
 ):
     try:
+        service = "resourcegroupstaggingapi" if resource_type == "TAGGING_API" else "ec2"
         # iterate over only spoke accounts
         if _account_id:
             target_role_arn = f"arn:aws:iam::{_account_id}:role/CIP_INSPECTOR"
-            ec2_client = create_client("ec2", target_role_arn, _region, _session)
+            ec2_client = create_client(service, target_role_arn, _region, _session)
         # iterate over only hub account
         else:
-            ec2_client = _session.client("ec2")
+            ec2_client = _session.client(service)
 
         all_tags = []
-        if resource_type == "EC2":
+        if resource_type == "TAGGING_API":
+            all_tags = tags_per_resource(
+                _account_id,
+                ec2_client,
+                item_per_page,
+                key_tag or "",
+                resource_type_filters or ["ec2:instance", "ec2:volume"],
+            )
+        elif resource_type == "EC2":
             all_tags = tags_per_ec2(_account_id, ec2_client, item_per_page, key_tag)
         elif resource_type == "VOLUME":
             all_tags = tags_per_volume(_account_id, ec2_client, item_per_page, key_tag)
@@ -1440,6 +1760,92 @@ def extract_inspector(
             raise err
 
 
+def get_inspector_statuses(ins_client, account_ids, _region: str):
+    """Reads the Inspector status of up to INSPECTOR_BATCH_SIZE accounts with one call.
+
+    The INSPECTOR_REPORTED_ERRORS are reported as the status of the accounts, the other errors are raised.
+    """
+    result = []
+    try:
+        response = ins_client.batch_get_account_status(accountIds=account_ids)
+    except ClientError as err:
+        # an expired token stops the run, the accounts are written to the resume file
+        if err.response["Error"]["Code"] not in INSPECTOR_REPORTED_ERRORS:
+            raise err
+        logger.error(
+            f"cannot read the inspector status of {','.join(account_ids)} in {_region} because of {err}"
+        )
+        return [
+            {
+                "account_id": account_id,
+                "region": _region,
+                "inspector status": err.response["Error"]["Code"],
+            }
+            for account_id in account_ids
+        ]
+
+    for account in response.get("accounts", []):
+        resource_state = account.get("resourceState", {})
+        result.append(
+            {
+                "account_id": account.get("accountId"),
+                "region": _region,
+                "inspector status": account.get("state", {}).get("status"),
+                "ec2": resource_state.get("ec2", {}).get("status"),
+                "ecr": resource_state.get("ecr", {}).get("status"),
+                "lambda": resource_state.get("lambda", {}).get("status"),
+            }
+        )
+    for account in response.get("failedAccounts", []):
+        result.append(
+            {
+                "account_id": account.get("accountId"),
+                "region": _region,
+                "inspector status": account.get("errorCode"),
+            }
+        )
+    return result
+
+
+def extract_inspector_delegated(
+    session: boto3.session.Session,
+    account_ids: dict,
+    admin_account_id: str = None,
+    max_workers: int = INSPECTOR_WORKERS,
+):
+    """Reads the Inspector status of the accounts from the delegated administrator.
+
+    account_ids maps every account to its region, the accounts are batched by
+    INSPECTOR_BATCH_SIZE per region and the batches run side by side. The
+    CIP_INSPECTOR role of admin_account_id is assumed once per region, the hub
+    session is used when it is not set.
+    """
+    regions = {}
+    for account_id, _region in account_ids.items():
+        regions.setdefault(_region, []).append(account_id)
+
+    batches = []
+    for _region, region_accounts in regions.items():
+        if admin_account_id:
+            target_role_arn = f"arn:aws:iam::{admin_account_id}:role/CIP_INSPECTOR"
+            ins_client = create_client("inspector2", target_role_arn, _region, session)
+        else:
+            ins_client = session.client("inspector2", region_name=_region)
+        for index in range(0, len(region_accounts), INSPECTOR_BATCH_SIZE):
+            batches.append(
+                (ins_client, region_accounts[index:index + INSPECTOR_BATCH_SIZE], _region)
+            )
+    logger.info(
+        f"{len(batches)} inspector batches for {len(account_ids)} accounts in {len(regions)} regions"
+    )
+
+    result = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for rows in executor.map(lambda batch: get_inspector_statuses(*batch), batches):
+            result.extend(rows)
+    return result
+
+
 def extract_event_rules(
     session: boto3.session.Session,
     _account_id: str = None,
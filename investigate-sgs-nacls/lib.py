@@ -1,7 +1,13 @@
+import os
+import sys
 import boto3
 import csv
 from boto3.dynamodb.conditions import Attr
 
+# the modules shared by the tools of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from spoke_metadata import load_spokes  # noqa: E402
+
 
 def create_creds(role, region):
     sts_client = boto3.client("sts")
@@ -35,24 +41,8 @@ def get_spoke_account_info(hub_account_name, network_type):
         & Attr("network-web-only").eq(False)
         & Attr("status").eq("Active")
     )
-    params = {"FilterExpression": filter_expression}
-
-    result = []
-    count = 0
-    while True:
-        response = table.scan(**params)
-        for item in response.get("Items", []):
-            result.append(item)
-            count = count + 1
-        if not response.get("LastEvaluatedKey"):
-            break
-
-        params.update(
-            {
-                "ExclusiveStartKey": response["LastEvaluatedKey"],
-            }
-        )
-    print(f"Count of accounts to be addressed: {count}")
+    result = load_spokes(table, filter_expression, ["account", "account-name", "region"])
+    print(f"Count of accounts to be addressed: {len(result)}")
     return result
 
 
@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 import os
 import sys
-from typing import Any, Generator, Tuple, List
+import time
+import random
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Generator, Tuple, List, Optional
 
 import boto3
+from botocore.exceptions import ClientError
 
 METADATA_PK_NAME = "account-name"
 METADATA_TABLE_NAME = "DYN_METADATA"
 DRY_RUN = False
+BULK = False
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", 16))
+BULK_MAX_ATTEMPTS = 6
+THROTTLING_ERROR_CODES = [
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+]
 
 
 def usage():
@@ -16,6 +28,7 @@ def usage():
     print("Parameters:")
     print("    -h, --help       - display help")
     print("    -n, --dry-run    - execute without real action")
+    print("    -b, --bulk       - update the items concurrently while the table is scanned")
     print()
     print("Environment variables:")
     print(
@@ -23,6 +36,7 @@ def usage():
     )
     print("    AWS_PROFILE=WH-0000-role_DEVOPS  - AWS profile to use")
     print("    AWS_REGION=eu-west-1             - AWS region to run")
+    print("    BULK_WORKERS=16                  - concurrent updates of the bulk mode")
     print()
     print("Notes:")
     print(
@@ -92,6 +106,74 @@ def update_item(item: dict, table, field_name: str, old_val: Any, new_val: Any)
         return item[METADATA_PK_NAME]
 
 
+def update_item_with_retry(
+    item: dict, table, field_name: str, old_val: Any, new_val: Any
+) -> Optional[str]:
+    """Retries update_item on throttling, returns None when the item no longer holds old_val."""
+    for attempt in range(BULK_MAX_ATTEMPTS):
+        try:
+            return update_item(item, table, field_name, old_val, new_val)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code == "ConditionalCheckFailedException":
+                return None
+            if code not in THROTTLING_ERROR_CODES or attempt == BULK_MAX_ATTEMPTS - 1:
+                raise e
+            # exponential backoff with full jitter
+            time.sleep(random.uniform(0, 0.1 * 2**attempt))
+
+
+def migrate_ddb_schema_bulk(
+    dynamodb,
+    table_name: str,
+    field_name: str,
+    old_val: Any,
+    new_val: Any,
+    workers: int = BULK_WORKERS,
+) -> Tuple[List[str], int]:
+    """Updates the items on a pool of workers while the scan is still running.
+
+    Returns the updated items and the number of conditional-check failures.
+    """
+    # the table actions only call its client, which is thread safe
+    table = dynamodb.Table(table_name)
+
+    result = []
+    conditional_failures = 0
+    in_flight = set()
+
+    def collect(done):
+        nonlocal conditional_failures
+        for future in done:
+            name = future.result()
+            if name is None:
+                conditional_failures += 1
+            else:
+                result.append(name)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in load_old_items(table, field_name, old_val):
+            # the scan waits for the workers, the pending updates stay bounded
+            if len(in_flight) >= 2 * workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(
+                executor.submit(
+                    update_item_with_retry, item, table, field_name, old_val, new_val
+                )
+            )
+        done, _ = wait(in_flight)
+        collect(done)
+
+    elapsed = time.monotonic() - started
+    print(
+        f"{len(result)} item(s) in {elapsed:.1f}s ({len(result) / elapsed if elapsed else 0:.1f} items/s), "
+        f"{conditional_failures} conditional-check failure(s)"
+    )
+    return result, conditional_failures
+
+
 def migrate_ddb_schema(
     dynamodb, table_name: str, field_name: str, old_val: Any, new_val: Any
 ) -> List[dict]:
@@ -110,8 +192,9 @@ def main():
         usage()
         exit(0)
 
-    global DRY_RUN
+    global DRY_RUN, BULK
     DRY_RUN = any([v.lower() in ["-n", "--dry-run"] for v in sys.argv])
+    BULK = any([v.lower() in ["-b", "--bulk"] for v in sys.argv])
 
     account_prefix = os.getenv("ACCOUNT_PREFIX", "").strip()
     aws_profile = os.getenv("AWS_PROFILE", "").strip()
@@ -134,7 +217,7 @@ def main():
 
     print()
     print(
-        f"Schema migration{' [DRY-RUN]' if DRY_RUN else ''} on DDB {table_name!r} table in {account_prefix} ({account_id}) account."
+        f"Schema migration{' [DRY-RUN]' if DRY_RUN else ''}{' [BULK]' if BULK else ''} on DDB {table_name!r} table in {account_prefix} ({account_id}) account."
     )
     print()
 
@@ -152,7 +235,14 @@ def main():
             f"Migrating {field_name!r} field from {type(old_val).__name__}({old_val!r}) to {type(new_val).__name__}({new_val!r}) ..."
         )
 
-        items = migrate_ddb_schema(dynamodb, table_name, field_name, old_val, new_val)
+        if BULK:
+            items, _ = migrate_ddb_schema_bulk(
+                dynamodb, table_name, field_name, old_val, new_val
+            )
+        else:
+            items = migrate_ddb_schema(
+                dynamodb, table_name, field_name, old_val, new_val
+            )
 
         if not items:
             print("everything is up-2-date")
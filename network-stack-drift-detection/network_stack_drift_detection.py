@@ -1,34 +1,134 @@
 #!/usr/bin/env python3
+import os
+import sys
 import logging
 import boto3
 import time
+import threading
 from boto3.dynamodb.conditions import Attr
 from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# the modules shared by the tools of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from spoke_metadata import load_spokes  # noqa: E402
 
 # Set logger
 logger = logging.getLogger(__name__)
 FORMAT = "[%(name)8s()]: %(message)s"
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
+# the drift detections started side by side
+DRIFT_WORKERS = 10
+DRIFT_POLL_DELAY = 5
+DRIFT_FINAL_STATUSES = ("DETECTION_COMPLETE", "DETECTION_FAILED")
+# the drift status of a stack whose detection cannot be described
+DRIFT_POLL_FAILED = "FAILED"
+# the assumed role credentials are renewed when they expire in less than that
+CREDS_MIN_VALIDITY = 600
+# the metadata attributes read by this script
+SPOKE_ATTRIBUTES = ["account", "account-name", "account-type", "region", "ip-range", "network-type", "internet-facing", "network-web-only"]
+_creds_cache = {}
+_creds_lock = threading.Lock()
+# the clients of the default session are created by one thread at a time
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_sts_client():
+    with _clients_lock:
+        return boto3.client("sts")
+
 
 def create_creds(role, region):
-    sts_client = boto3.client("sts")
-    return sts_client.assume_role(RoleArn=role, RoleSessionName="public-nacl-update")
+    """Returns the credentials of the role, reused while they stay valid for CREDS_MIN_VALIDITY seconds."""
+    with _creds_lock:
+        creds = _creds_cache.get(role)
+    if creds is None or creds["Credentials"]["Expiration"] - datetime.now(timezone.utc) < timedelta(seconds=CREDS_MIN_VALIDITY):
+        creds = get_sts_client().assume_role(RoleArn=role, RoleSessionName="public-nacl-update")
+        with _creds_lock:
+            _creds_cache[role] = creds
+    return creds
 
 
 def create_client(service, role, region):
-    """Creates a BOTO3 client using the correct target accounts Role."""
+    """Creates a BOTO3 client using the correct target accounts Role, reused until its credentials are renewed."""
     creds = create_creds(role, region)
-    client = boto3.client(
-        service,
-        aws_access_key_id=creds["Credentials"]["AccessKeyId"],
-        aws_secret_access_key=creds["Credentials"]["SecretAccessKey"],
-        aws_session_token=creds["Credentials"]["SessionToken"],
-        region_name=region,
-    )
+    key = (service, role, region)
+    with _clients_lock:
+        access_key_id, client = _clients.get(key, (None, None))
+        if access_key_id != creds["Credentials"]["AccessKeyId"]:
+            client = boto3.client(
+                service,
+                aws_access_key_id=creds["Credentials"]["AccessKeyId"],
+                aws_secret_access_key=creds["Credentials"]["SecretAccessKey"],
+                aws_session_token=creds["Credentials"]["SessionToken"],
+                region_name=region,
+            )
+            _clients[key] = (creds["Credentials"]["AccessKeyId"], client)
     return client
 
 
+def spoke_role(spoke):
+    return f"arn:aws:iam::{spoke['account']}:role/AWS_PLATFORM_ADMIN"
+
+
+def start_spoke(spoke):
+    """Starts the drift detection of the NETWORK-STACK of the spoke, returns its id or None."""
+    try:
+        cfn_client = create_client("cloudformation", spoke_role(spoke), spoke["region"])
+    except Exception as e:
+        logger.error(f"Error creating the clients of spoke {spoke['account-name']}:")
+        logger.error(e)
+        return None
+
+    logger.info(f"Checking spoke {spoke['account-name']} compliance.")
+    try:
+        return detect_stack_drift(cfn_client, spoke["account-name"])
+    except Exception:
+        return None
+
+
+def poll_drift_detections(drift_detections, drift_statuses):
+    """Polls the drift detections of every spoke together until they are all finished.
+
+    The drift status of every spoke is written to drift_statuses, DRIFT_POLL_FAILED
+    when its detection cannot be described.
+    """
+    pending = dict(drift_detections)
+    while pending:
+        for stack_drift_detection_id, spoke in list(pending.items()):
+            try:
+                # the client is created again when the credentials of the spoke are renewed
+                cfn_client = create_client("cloudformation", spoke_role(spoke), spoke["region"])
+                drift_detection = describe_drift_detection(
+                    cfn_client, stack_drift_detection_id
+                )
+            except Exception:
+                del pending[stack_drift_detection_id]
+                drift_statuses[spoke["account-name"]] = DRIFT_POLL_FAILED
+                continue
+            if drift_detection["DetectionStatus"] in DRIFT_FINAL_STATUSES:
+                del pending[stack_drift_detection_id]
+                drift_statuses[spoke["account-name"]] = drift_detection["StackDriftStatus"]
+        if pending:
+            time.sleep(DRIFT_POLL_DELAY)
+
+
+def report_drift_statuses(drift_statuses):
+    for spoke_name, drift_status in sorted(drift_statuses.items()):
+        if drift_status == DRIFT_POLL_FAILED:
+            logger.error(f"{spoke_name}-NETWORK-STACK drift status could not be read.")
+        elif drift_status != "IN_SYNC":
+            logger.info(
+                f"{spoke_name}-NETWORK-STACK drift status: {drift_status}. Check account for more information."
+            )
+
+
 def main(hub_env):
     try:
         table_name = f"{hub_env}-DYN_METADATA"
@@ -41,18 +141,34 @@ def main(hub_env):
 
         spoke_list = get_spokes(table_name, accounts_filter)
 
+        # the drift detections of every spoke are started first
+        with ThreadPoolExecutor(max_workers=DRIFT_WORKERS) as executor:
+            drift_detection_ids = list(executor.map(start_spoke, spoke_list))
+    except Exception as e:
+        logger.error(e)
+        return
+
+    drift_detections = {
+        stack_drift_detection_id: spoke
+        for spoke, stack_drift_detection_id in zip(spoke_list, drift_detection_ids)
+        if stack_drift_detection_id
+    }
+    drift_statuses = {}
+    # and polled together while the route tables are checked
+    poller = threading.Thread(
+        target=poll_drift_detections, args=(drift_detections, drift_statuses), daemon=True
+    )
+    poller.start()
+    try:
         for spoke in spoke_list:
-            account_number = spoke["account"]
-            role = f"arn:aws:iam::{account_number}:role/AWS_PLATFORM_ADMIN"
-            region = spoke["region"]
-            ec2_client = create_client("ec2", role, region)
-            cfn_client = create_client("cloudformation", role, region)
-            logger.info(f"Checking spoke {spoke['account-name']} compliance.")
-            check_drift = check_drift_detection(cfn_client, spoke["account-name"])
-            if check_drift["StackDriftStatus"] != "IN_SYNC":
-                logger.info(
-                    f"{spoke['account-name']}-NETWORK-STACK drift status: {check_drift['StackDriftStatus']}. Check account for more information."
-                )
+            try:
+                # the clients are created when the spoke is checked, with credentials renewed if needed
+                ec2_client = create_client("ec2", spoke_role(spoke), spoke["region"])
+                cfn_client = create_client("cloudformation", spoke_role(spoke), spoke["region"])
+            except Exception as e:
+                logger.error(f"Error creating the clients of spoke {spoke['account-name']}:")
+                logger.error(e)
+                continue
             logger.info(f"Checking spoke {spoke['account-name']} route tables.")
             vpc_default_routes = [
                 {
@@ -74,18 +190,20 @@ def main(hub_env):
                 check_standalone_rts(ec2_client, cfn_client, spoke, vpc_default_routes)
     except Exception as e:
         logger.error(e)
+    finally:
+        poller.join()
+        report_drift_statuses(drift_statuses)
 
 
 def check_connected_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
     try:
-        local_rts = get_route_tables(ec2_client, "local-subnet-routetable-*")
-        private_rts = get_route_tables(ec2_client, "private-subnet-routetable-*")
+        route_tables = RouteTableIndex(ec2_client)
+        local_rts = route_tables.get_route_tables("local-subnet-routetable-*")
+        private_rts = route_tables.get_route_tables("private-subnet-routetable-*")
 
         if spoke["network-type"] == "Connected-4-Tier-2-AZ":
             if spoke.get("internet-facing") is True:
-                firewall_rts = get_route_tables(
-                    ec2_client, "AWSFirewallManagerManagedResource"
-                )
+                firewall_rts = route_tables.get_route_tables("AWSFirewallManagerManagedResource")
                 for firewall_rt in firewall_rts:
                     for route in firewall_rt["Routes"]:
                         if route not in vpc_default_routes:
@@ -99,7 +217,7 @@ def check_connected_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                                 print(
                                     f"Route {route} is not matching the expected architecture in {firewall_rt['RouteTableId']} firewall route table"
                                 )
-                public_rts = get_route_tables(ec2_client, "public-subnet-routetable-*")
+                public_rts = route_tables.get_route_tables("public-subnet-routetable-*")
                 for public_rt in public_rts:
                     for route in public_rt["Routes"]:
                         if route not in vpc_default_routes:
@@ -115,7 +233,7 @@ def check_connected_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                                 print(
                                     f"Route {route} is not matching the expected architecture in {public_rt['RouteTableId']} public route table"
                                 )
-                igw_rt = get_route_tables(ec2_client, "IGW-routetable")
+                igw_rt = route_tables.get_route_tables("IGW-routetable")
                 cidr = spoke["ip-range"][:-4]
                 public_subnets_cidrs = [cidr + "128/27", cidr + "160/27"]
                 for route in igw_rt[0]["Routes"]:
@@ -167,7 +285,7 @@ def check_connected_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                                 )
 
         elif spoke["network-type"] == "Connected-4-Tier-3-AZ":
-            public_rts = get_route_tables(ec2_client, "public-subnet-routetable-*")
+            public_rts = route_tables.get_route_tables("public-subnet-routetable-*")
             if spoke.get("internet-facing") is True:
                 for public_rt in public_rts:
                     for route in public_rt["Routes"]:
@@ -223,7 +341,7 @@ def check_connected_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                 if keyName == "PrivateRoutingTables":
                     private_rts = output["OutputValue"].split(",")
             for private_rt in private_rts:
-                routes = get_routes(ec2_client, private_rt)
+                routes = route_tables.get_routes(private_rt)
                 for route in routes:
                     if route not in vpc_default_routes:
                         if route.get(
@@ -258,9 +376,10 @@ def check_connected_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
 
 def check_standalone_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
     try:
-        local_rts = get_route_tables(ec2_client, "local-subnet-routetable-*")
-        private_rts = get_route_tables(ec2_client, "private-subnet-routetable-*")
-        public_rts = get_route_tables(ec2_client, "public-subnet-routetable-*")
+        route_tables = RouteTableIndex(ec2_client)
+        local_rts = route_tables.get_route_tables("local-subnet-routetable-*")
+        private_rts = route_tables.get_route_tables("private-subnet-routetable-*")
+        public_rts = route_tables.get_route_tables("public-subnet-routetable-*")
         if spoke["network-type"] == "Standalone-4-Tier-3-AZ":
             if spoke.get("network-web-only") is True:
                 for public_rt in public_rts:
@@ -291,9 +410,7 @@ def check_standalone_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                                     f"Route {route} is not matching the expected architecture in {public_rt['RouteTableId']} public route table"
                                 )
 
-                firewall_rts = get_route_tables(
-                    ec2_client, "AWSFirewallManagerManagedResource"
-                )
+                firewall_rts = route_tables.get_route_tables("AWSFirewallManagerManagedResource")
                 for firewall_rt in firewall_rts:
                     for route in firewall_rt["Routes"]:
                         if route not in vpc_default_routes:
@@ -308,7 +425,7 @@ def check_standalone_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                                     f"Route {route} is not matching the expected architecture in {firewall_rt['RouteTableId']} firewall route table"
                                 )
 
-                igw_rt = get_route_tables(ec2_client, "IGW-routetable")
+                igw_rt = route_tables.get_route_tables("IGW-routetable")
                 cidr = spoke["ip-range"][:-6]
                 public_subnets_cidrs = [
                     cidr + "32.0/21",
@@ -356,7 +473,7 @@ def check_standalone_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                 output["OutputKey"]: output["OutputValue"] for output in outputs
             }
             public_rt = stack_outputs["PublicRoutingTable"]
-            public_routes = get_routes(ec2_client, public_rt)
+            public_routes = route_tables.get_routes(public_rt)
             private_rts = [
                 stack_outputs["PrivateRoutingTableA"],
                 stack_outputs["PrivateRoutingTableB"],
@@ -373,7 +490,7 @@ def check_standalone_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                             f"Route {route} is not matching the expected architecture in {public_rt} public route table"
                         )
             for private_rt in private_rts:
-                routes = get_routes(ec2_client, private_rt)
+                routes = route_tables.get_routes(private_rt)
                 for route in routes:
                     if route not in vpc_default_routes:
                         if route.get(
@@ -396,7 +513,7 @@ def check_standalone_rts(ec2_client, cfn_client, spoke, vpc_default_routes):
                     cfn_client, spoke["account-name"], external_rts_ids
                 )
                 for external_rt in external_rts:
-                    routes = get_routes(ec2_client, external_rt)
+                    routes = route_tables.get_routes(external_rt)
                     for route in routes:
                         if route not in vpc_default_routes:
                             if route.get(
@@ -431,25 +548,6 @@ def get_external_rts(cfn_client, spoke_name, external_rts_ids):
         raise Exception("Error describing external subnet route tables")
 
 
-def check_drift_detection(cfn_client, spoke_name):
-    try:
-        stack_drift_detection_id = detect_stack_drift(cfn_client, spoke_name)
-        while True:
-            drift_detection = describe_drift_detection(
-                cfn_client, stack_drift_detection_id
-            )
-            if drift_detection["DetectionStatus"] in (
-                "DETECTION_COMPLETE",
-                "DETECTION_FAILED",
-            ):
-                return drift_detection
-            time.sleep(5)
-    except Exception as e:
-        logger.error("Error checking network stack drift:")
-        logger.error(e)
-        raise Exception("Error checking network stack drift.")
-
-
 def describe_drift_detection(cfn_client, stack_drift_detection_id):
     try:
         response = cfn_client.describe_stack_drift_detection_status(
@@ -552,62 +650,56 @@ def check_cnx_routes(spoke_info, route_tables):
         logger.error(e)
 
 
-def get_routes(ec2_client, rt_id):
-    try:
-        routes = ec2_client.describe_route_tables(
-            RouteTableIds=[
-                rt_id,
-            ],
-        )[
-            "RouteTables"
-        ][0]["Routes"]
-        return routes
-    except Exception as e:
-        logger.error("Error getting routes:")
-        logger.error(e)
-        raise Exception("Error getting routes.")
+class RouteTableIndex:
+    """The route tables of the spoke, read once and indexed by id and Name tag."""
 
-
-def get_route_tables(ec2_client, rt_type):
-    try:
-        route_tables = ec2_client.describe_route_tables(
-            Filters=[
-                {
-                    "Name": "tag:Name",
-                    "Values": [
-                        rt_type,
-                    ],
-                }
+    def __init__(self, ec2_client):
+        try:
+            self._route_tables = [
+                route_table
+                for page in ec2_client.get_paginator("describe_route_tables").paginate()
+                for route_table in page["RouteTables"]
             ]
-        )["RouteTables"]
-        return route_tables
-    except Exception as e:
-        logger.error("Error getting route tables:")
-        logger.error(e)
-        raise Exception("Error getting route tables.")
+        except Exception as e:
+            logger.error("Error getting route tables:")
+            logger.error(e)
+            raise Exception("Error getting route tables.")
+        self._by_id = {
+            route_table["RouteTableId"]: route_table for route_table in self._route_tables
+        }
+        self._by_name = {}
+
+    @staticmethod
+    def _name(route_table):
+        for tag in route_table.get("Tags", []):
+            if tag["Key"] == "Name":
+                return tag["Value"]
+        return None
+
+    def get_route_tables(self, rt_type):
+        """Returns the route tables whose Name tag matches the rt_type glob, as the tag:Name filter."""
+        if rt_type not in self._by_name:
+            self._by_name[rt_type] = [
+                route_table
+                for route_table in self._route_tables
+                if self._name(route_table) is not None
+                and fnmatchcase(self._name(route_table), rt_type)
+            ]
+        return self._by_name[rt_type]
+
+    def get_routes(self, rt_id):
+        if rt_id not in self._by_id:
+            logger.error("Error getting routes:")
+            logger.error(f"the route table {rt_id} is not found")
+            raise Exception("Error getting routes.")
+        return self._by_id[rt_id]["Routes"]
 
 
 def get_spokes(table_name, filter):
     table = boto3.resource("dynamodb", region_name="eu-west-1").Table(table_name)
 
-    params = {"TableName": table_name, "FilterExpression": filter}
-
-    result = []
-    count = 0
-    while True:
-        response = table.scan(**params)
-        for item in response.get("Items", []):
-            result.append(item)
-            count = count + 1
-        if not response.get("LastEvaluatedKey"):
-            break
-
-        params.update(
-            {
-                "ExclusiveStartKey": response["LastEvaluatedKey"],
-            }
-        )
-    print(f"Count of accounts to be addressed: {count}")
+    result = load_spokes(table, filter, SPOKE_ATTRIBUTES)
+    print(f"Count of accounts to be addressed: {len(result)}")
     return result
 
 
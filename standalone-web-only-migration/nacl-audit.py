@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
+import os
+import sys
 import logging
 import boto3
 from boto3.dynamodb.conditions import Attr
 from argparse import ArgumentParser
 
+# the modules shared by the tools of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from spoke_metadata import load_spokes  # noqa: E402
+
 # Set logger
 logger = logging.getLogger(__name__)
 FORMAT = "[%(name)8s()]: %(message)s"
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
+# the metadata attributes read by this script
+SPOKE_ATTRIBUTES = ["account", "account-name", "region", "ip-range"]
+
 
 def create_creds(role, region):
     sts_client = boto3.client("sts")
@@ -149,24 +158,8 @@ def main(hub_env, network_type):
 def get_spokes(table_name, filter):
     table = boto3.resource("dynamodb", region_name="eu-west-1").Table(table_name)
 
-    params = {"TableName": table_name, "FilterExpression": filter}
-
-    result = []
-    count = 0
-    while True:
-        response = table.scan(**params)
-        for item in response.get("Items", []):
-            result.append(item)
-            count = count + 1
-        if not response.get("LastEvaluatedKey"):
-            break
-
-        params.update(
-            {
-                "ExclusiveStartKey": response["LastEvaluatedKey"],
-            }
-        )
-    print(f"Count of accounts to be addressed: {count}")
+    result = load_spokes(table, filter, SPOKE_ATTRIBUTES)
+    print(f"Count of accounts to be addressed: {len(result)}")
     return result
 
 
@@ -0,0 +1,240 @@
+# -----------------------------------------------------------------
+# coercion.py
+#
+# Attribute coercion engine of the metadata tables. Every scanned item is
+# planned against the rules (string to bool, string to number, rename) and the
+# conditional updates of a page run on a pool of workers while the next page is
+# scanned.
+#
+# The LastEvaluatedKey of the last page whose updates are all done is written to
+# a checkpoint file, an interrupted run started again with the same table and
+# rules resumes from there. The updates are conditional on the old value, so the
+# items of a page processed twice are not changed twice.
+#
+# -----------------------------------------------------------------
+
+import os
+import json
+import logging
+
+from time import monotonic
+from typing import Any, NamedTuple
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+STR_TO_BOOL = "bool"
+STR_TO_NUMBER = "number"
+RENAME = "rename"
+RULE_KINDS = [STR_TO_BOOL, STR_TO_NUMBER, RENAME]
+WORKERS = 16
+# the scanned pages waiting for their updates, the scan waits beyond it
+MAX_PENDING_PAGES = 4
+
+
+class Rule(NamedTuple):
+    attribute: str
+    kind: str
+    # the new name of a RENAME rule
+    target: str = None
+
+
+def parse_rule(text: str) -> Rule:
+    """Parses attribute:bool, attribute:number or attribute:rename:new-name."""
+    parts = text.split(":")
+    if len(parts) < 2 or parts[1] not in RULE_KINDS:
+        raise ValueError(f"invalid rule {text}, expected attribute:{'|'.join(RULE_KINDS)}")
+    if parts[1] == RENAME:
+        if len(parts) != 3 or not parts[2]:
+            raise ValueError(f"invalid rule {text}, expected attribute:rename:new-name")
+        return Rule(parts[0], RENAME, parts[2])
+    return Rule(parts[0], parts[1])
+
+
+def cast_bool(value: Any) -> bool:
+    return str(value).lower() in ("on", "yes", "true", "1")
+
+
+def cast_number(value: str) -> str:
+    """Returns the number of the string in the N format, raises ValueError when it is not one."""
+    text = value.strip()
+    float(text)
+    return text
+
+
+def _coerce(rule: Rule, value: dict):
+    """Returns the new low level value of the rule, None when there is nothing to change."""
+    if rule.kind == RENAME:
+        return value
+    if "S" not in value:
+        return None
+    if rule.kind == STR_TO_BOOL:
+        return {"BOOL": cast_bool(value["S"])}
+    return {"N": cast_number(value["S"])}
+
+
+def _display(value: dict):
+    return next(iter(value.values()))
+
+
+def plan_update(item: dict, rules, table_name: str, key_name: str):
+    """Builds the conditional update_item of the item and its diff lines.
+
+    Returns (None, diff) when the item already matches the rules.
+    """
+    sets, removes, conditions, diff = [], [], [], []
+    names, values = {}, {}
+    for index, rule in enumerate(rules):
+        if rule.attribute not in item:
+            continue
+        old_value = item[rule.attribute]
+        try:
+            new_value = _coerce(rule, old_value)
+        except ValueError:
+            diff.append(f"{rule.attribute}: {_display(old_value)!r} is not a number, skipped")
+            continue
+        if new_value is None:
+            continue
+
+        names[f"#a{index}"] = rule.attribute
+        values[f":o{index}"] = old_value
+        values[f":n{index}"] = new_value
+        # the item still holds the scanned value
+        conditions.append(f"#a{index} = :o{index}")
+        if rule.kind == RENAME:
+            names[f"#t{index}"] = rule.target
+            sets.append(f"#t{index} = :n{index}")
+            removes.append(f"#a{index}")
+            conditions.append(f"attribute_not_exists(#t{index})")
+            diff.append(f"{rule.attribute} -> {rule.target}: {_display(old_value)!r}")
+        else:
+            sets.append(f"#a{index} = :n{index}")
+            diff.append(f"{rule.attribute}: {_display(old_value)!r} -> {_display(new_value)!r}")
+
+    if not sets:
+        return None, diff
+
+    update_expression = f"SET {', '.join(sets)}"
+    if removes:
+        update_expression += f" REMOVE {', '.join(removes)}"
+    return (
+        {
+            "TableName": table_name,
+            "Key": {key_name: item[key_name]},
+            "UpdateExpression": update_expression,
+            "ConditionExpression": " AND ".join(conditions),
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+        },
+        diff,
+    )
+
+
+def _update(client, params) -> bool:
+    """Returns False when the item changed since it was scanned."""
+    try:
+        client.update_item(**params)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise e
+
+
+class Checkpoint:
+    """LastEvaluatedKey of the last fully processed page of a table and its rules."""
+
+    def __init__(self, filename: str, table_name: str, rules):
+        self.filename = filename
+        self._identity = {"table": table_name, "rules": [list(rule) for rule in rules]}
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename) as f:
+            checkpoint = json.load(f)
+        if {key: checkpoint.get(key) for key in self._identity} != self._identity:
+            LOGGER.warning(f"{self.filename} is for another table or other rules, it is ignored")
+            return None
+        return checkpoint["last_evaluated_key"]
+
+    def save(self, last_evaluated_key):
+        temp_name = f"{self.filename}.tmp"
+        with open(temp_name, "w") as f:
+            json.dump({**self._identity, "last_evaluated_key": last_evaluated_key}, f)
+        os.replace(temp_name, self.filename)
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def coerce_table(
+    client,
+    scan_params: dict,
+    rules,
+    key_name: str,
+    checkpoint: Checkpoint = None,
+    dry_run: bool = False,
+    workers: int = WORKERS,
+):
+    """Applies the rules to every item of the scan and returns the counters of the run."""
+    table_name = scan_params["TableName"]
+    params = dict(scan_params)
+    if checkpoint:
+        start_key = checkpoint.load()
+        if start_key:
+            LOGGER.info(f"resuming {table_name} from {start_key}")
+            params["ExclusiveStartKey"] = start_key
+
+    stats = {"scanned": 0, "planned": 0, "updated": 0, "conditional_failures": 0}
+    # the updates of every page in scan order with the key to resume after it
+    pending = []
+
+    def settle(max_pending: int):
+        while pending and (
+            len(pending) > max_pending or all(future.done() for future in pending[0][0])
+        ):
+            futures, last_evaluated_key = pending.pop(0)
+            for future in futures:
+                if future.result():
+                    stats["updated"] += 1
+                else:
+                    stats["conditional_failures"] += 1
+            if checkpoint and not dry_run and last_evaluated_key:
+                checkpoint.save(last_evaluated_key)
+
+    started = monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            response = client.scan(**params)
+            futures = []
+            for item in response.get("Items", []):
+                stats["scanned"] += 1
+                update, diff = plan_update(item, rules, table_name, key_name)
+                if diff:
+                    LOGGER.info(f"{_display(item[key_name])}: {'; '.join(diff)}")
+                if update is None:
+                    continue
+                stats["planned"] += 1
+                if not dry_run:
+                    futures.append(executor.submit(_update, client, update))
+            pending.append((futures, response.get("LastEvaluatedKey")))
+            settle(MAX_PENDING_PAGES)
+
+            if not response.get("LastEvaluatedKey"):
+                break
+            params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        settle(0)
+
+    if checkpoint and not dry_run:
+        checkpoint.clear()
+    elapsed = monotonic() - started
+    LOGGER.info(
+        f"{stats['scanned']} items scanned, {stats['planned']} to update, {stats['updated']} updated, "
+        f"{stats['conditional_failures']} conditional-check failures in {elapsed:.1f}s "
+        f"({stats['updated'] / elapsed if elapsed else 0:.1f} items/s)"
+    )
+    return stats
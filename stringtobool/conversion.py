@@ -2,7 +2,8 @@
 import logging
 import boto3
 from argparse import ArgumentParser
-from typing import Any
+from botocore.config import Config
+from coercion import STR_TO_BOOL, WORKERS, Checkpoint, Rule, coerce_table, parse_rule
 
 # Set logger
 LOGGER = logging.getLogger(__name__)
@@ -27,59 +28,45 @@ def create_client(service, role, region):
     return client
 
 
-def cast_bool(value: Any) -> bool:
-    return str(value).lower() in ("on", "yes", "true", "1")
-
-
-def main(hub_env):
+def main(hub_env, rules, dry_run=False, workers=WORKERS):
     table_name = f"WH-{hub_env}-DYN_METADATA"
+    attributes = {"#accname": "account-name"}
+    attributes.update({f"#r{index}": rule.attribute for index, rule in enumerate(rules)})
     params = {
         "TableName": table_name,
         "FilterExpression": "#s = :active",
-        "Select": "SPECIFIC_ATTRIBUTES",
-        "ProjectionExpression": "account,#if,#accname",
-        "ExpressionAttributeNames": {
-            "#s": "status",
-            "#if": "internet-facing",
-            "#accname": "account-name",
-        },
+        "ProjectionExpression": ",".join(attributes),
+        "ExpressionAttributeNames": {"#s": "status", **attributes},
         "ExpressionAttributeValues": {":active": {"S": "Active"}},
     }
 
-    client = boto3.client("dynamodb", "eu-west-1")
-    count = 0
-    while True:
-        response = client.scan(**params)
-        for item in response.get("Items", []):
-            account_name = item["account-name"]["S"]
-            print(item)
-            if "internet-facing" in item and "S" in item["internet-facing"]:
-                count += 1
-                update_params = {
-                    "TableName": table_name,
-                    "Key": {"account-name": {"S": account_name}},
-                    "UpdateExpression": "SET #if = :val",
-                    "ExpressionAttributeNames": {"#if": "internet-facing"},
-                    "ExpressionAttributeValues": {
-                        ":val": {"BOOL": cast_bool(item["internet-facing"]["S"])}
-                    },
-                }
-
-                client.update_item(**update_params)
-
-        if not response.get("LastEvaluatedKey"):
-            break
-
-        params.update(
-            {
-                "ExclusiveStartKey": response["LastEvaluatedKey"],
-            }
-        )
-    print(f"Count of accounts to be addressed: {count}")
+    client = boto3.client(
+        "dynamodb",
+        "eu-west-1",
+        config=Config(retries={"mode": "adaptive", "max_attempts": 10}),
+    )
+    checkpoint = Checkpoint(f"{table_name}-checkpoint.json", table_name, rules)
+    stats = coerce_table(
+        client, params, rules, "account-name", checkpoint, dry_run, workers
+    )
+    print(f"Count of accounts to be addressed: {stats['planned']}")
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
-    parser.add_argument("hub_env", type=str, required=True)
+    parser.add_argument("hub_env", type=str)
+    parser.add_argument(
+        "--rule",
+        action="append",
+        type=parse_rule,
+        help="attribute:bool, attribute:number or attribute:rename:new-name, internet-facing:bool by default",
+    )
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only print the changes")
+    parser.add_argument("--workers", type=int, default=WORKERS)
     args = parser.parse_args()
-    main(args.hub_env)
+    main(
+        args.hub_env,
+        args.rule or [Rule("internet-facing", STR_TO_BOOL)],
+        args.dry_run,
+        args.workers,
+    )